@@ -0,0 +1,379 @@
+"""
+Benchmarks of the crypto, vault and transfer hot paths, and of CLI startup.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench [--quick] [--output results.json] [--compare baseline.json]
+
+Every benchmark is repeated, and the best and median wall clock times are
+reported. Results are written as JSON, so that runs of different releases
+can be compared with --compare. Transfers go through the CLI commands
+against the local and in-memory providers, so no credentials or network
+are needed.
+
+The startup suite runs 'python -m cfe' in fresh interpreters and reports
+how long the imports took, from python -X importtime. Commands that do not
+touch a vault or a provider must not import the heavy dependencies; the run
+fails if one of them does.
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import click
+import cryptography
+from click.testing import CliRunner
+
+from cfe import __main__ as cli_main
+from cfe import chunking, compression, providers
+from cfe.vault import crypto
+from cfe.vault import storage as vault
+
+PASSWORD = "benchmark password"
+KIB = 1024
+MIB = 1024 * KIB
+
+PAYLOAD_SIZES = [KIB, 64 * KIB, MIB, 16 * MIB, 64 * MIB]
+VAULT_SIZES = [10, 100, 1000, 10000]
+TRANSFER_SIZES = [MIB, 16 * MIB, 64 * MIB]
+LOOKUPS = 10000
+# Records of a vault that predates the vault header, each with its own scrypt salt
+LEGACY_RECORDS = 32
+REPEAT = 5
+
+QUICK_PAYLOAD_SIZES = [KIB, 64 * KIB, MIB, 4 * MIB]
+QUICK_VAULT_SIZES = [10, 100, 1000]
+QUICK_TRANSFER_SIZES = [MIB, 4 * MIB]
+QUICK_REPEAT = 3
+QUICK_LEGACY_RECORDS = 8
+
+# Ratio of medians above which --compare reports a regression
+REGRESSION = 1.10
+
+# Commands whose startup is measured, none of which may import HEAVY_MODULES
+STARTUP_COMMANDS = [('--help',), ('list', '--help'), ('init',)]
+HEAVY_MODULES = ['cryptography', 'tqdm', 'httplib2', 'pydrive2', 'googleapiclient']
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(func, repeat, setup=None):
+    """
+    Returns the best and median of repeat timed calls of func, in seconds.
+    setup, if given, runs untimed before every call.
+    """
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {'best': min(runs), 'median': statistics.median(runs), 'runs': len(runs)}
+
+
+def result(suite, name, params, timing, size=None, operations=1):
+    """
+    Returns one benchmark result. Throughput is reported for size bytes and
+    latency for timings that cover several operations.
+    """
+    entry = {'suite': suite, 'name': name, 'params': params, 'seconds': timing}
+    if size is not None:
+        entry['mb_per_s'] = size / MIB / timing['median'] if timing['median'] else None
+    if operations > 1:
+        entry['us_per_op'] = timing['median'] / operations * 1e6
+    return entry
+
+
+def bench_crypto(sizes, repeat):
+    results = []
+    key = crypto.generate_random_key()
+
+    timing = measure(lambda: crypto.generate_password_key(PASSWORD, os.urandom(16)), repeat)
+    results.append(result('crypto', 'password_kdf', {}, timing))
+
+    for size in sizes:
+        data = os.urandom(size)
+        params = {'bytes': size}
+
+        def stream_encrypt():
+            return crypto.EncryptingReader(key, io.BytesIO(data), size).read()
+
+        ciphertext = stream_encrypt()
+
+        def stream_decrypt():
+            decryptor = crypto.StreamDecryptor(key)
+            return decryptor.update(ciphertext) + decryptor.finalize()
+
+        token = crypto.encrypt(key, data)
+        results.append(result('crypto', 'stream_encrypt', params, measure(stream_encrypt, repeat), size))
+        results.append(result('crypto', 'stream_decrypt', params, measure(stream_decrypt, repeat), size))
+        results.append(result('crypto', 'fernet_encrypt', params,
+                              measure(lambda: crypto.encrypt(key, data), repeat), size))
+        results.append(result('crypto', 'fernet_decrypt', params,
+                              measure(lambda: crypto.decrypt(key, token), repeat), size))
+
+        # Text is what compression is for; random data is what auto detection skips
+        text = b"".join(b"%d,benchmark,row,%d\n" % (i, i * 7) for i in range(size // 20 + 1))[:size]
+        results.append(result('crypto', 'compress_text', params,
+                              measure(lambda: compression.compress_file(io.BytesIO(text), io.BytesIO(),
+                                                                        compression.ZLIB), repeat), size))
+        results.append(result('crypto', 'choose_compression', params,
+                              measure(lambda: compression.choose(io.BytesIO(data)), repeat)))
+        chunker = chunking.Chunker(key)
+        results.append(result('crypto', 'chunk_split', params,
+                              measure(lambda: list(chunker.split(io.BytesIO(data))), repeat), size))
+    return results
+
+
+def bench_vault(sizes, repeat):
+    results = []
+    for n in sizes:
+        with _workdir():
+            v = _vault(n)
+            params = {'entries': n}
+            results.append(result('vault', 'unlock', params, measure(lambda: vault.Vault(PASSWORD), repeat)))
+            results.append(result('vault', 'save', params, measure(v._on_save, repeat)))
+
+            names = {'count': 0}
+
+            def create():
+                names['count'] += 1
+                v.create_data(f"bench/new/{names['count']}", f"guid-new-{names['count']}")
+
+            results.append(result('vault', 'create_data', params, measure(create, repeat)))
+
+            nicknames = [random.choice(v.nicknames) for _ in range(LOOKUPS)]
+
+            def lookup():
+                for nickname in nicknames:
+                    v.get_data(nickname)
+
+            results.append(result('vault', 'get_data', params, measure(lookup, repeat), operations=LOOKUPS))
+            results.append(result('vault', 'get_data_list_prefix', params,
+                                  measure(lambda: v.get_data_list("bench/0/"), repeat)))
+    return results
+
+
+def bench_legacy_unlock(records, repeat):
+    with _workdir():
+        os.makedirs(os.path.dirname(vault.VAULT_PATH), exist_ok=True)
+        # Half of the records belong to another password and are tried on every unlock
+        legacy = b"".join(vault.VaultEntry(f"file-{i}", f"guid-{i}").encrypt_entry(PASSWORD if i % 2 else "other")
+                          + b"\n" for i in range(records))
+
+        def restore():
+            with open(vault.VAULT_PATH, 'wb') as f:
+                f.write(legacy)
+
+        timing = measure(lambda: vault.Vault(PASSWORD), repeat, setup=restore)
+    return [result('vault', 'unlock_legacy', {'records': records, 'cpus': os.cpu_count()}, timing)]
+
+
+def bench_transfer(sizes, repeat):
+    results = []
+    for provider in ['memory', 'local']:
+        for size in sizes:
+            with _workdir() as workdir:
+                _run('init')
+                if provider == 'local':
+                    providers.select(provider, root=os.path.join(workdir, 'remote'))
+                else:
+                    # Files in memory outlive a command only within this process, so it is never recorded
+                    providers.use(providers.create(provider))
+                with open('payload.bin', 'wb') as f:
+                    f.write(os.urandom(size))
+
+                params = {'provider': provider, 'bytes': size}
+                uploads = {'count': 0}
+
+                def upload():
+                    uploads['count'] += 1
+                    _run('upload', '--compress', 'none', 'payload.bin', f"payload-{uploads['count']}")
+
+                def download():
+                    _run('download', f"payload-{uploads['count']}", 'restored.bin')
+
+                def remove_download():
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove('restored.bin')
+
+                results.append(result('transfer', 'upload', params, measure(upload, repeat), size))
+                results.append(result('transfer', 'download', params,
+                                      measure(download, repeat, setup=remove_download), size))
+    # Later runs in this process should not inherit the last backend
+    providers.use(None)
+    return results
+
+
+def bench_startup(repeat):
+    results = []
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    with _workdir():
+        for args in STARTUP_COMMANDS:
+            timing = measure(lambda: _cfe(args, env), repeat)
+            imports = _import_times(_cfe(args, env, '-X', 'importtime').stderr)
+            entry = result('startup', ' '.join(args), {}, timing)
+            entry['import_us'] = sum(cumulative for _, cumulative, depth in imports if depth == 0)
+            imported = {name for name, _, _ in imports}
+            entry['heavy_imports'] = [name for name in HEAVY_MODULES if name in imported]
+            results.append(entry)
+    return results
+
+
+def compare(results, baseline):
+    """
+    Prints how every result changed against the baseline run and returns
+    the number of regressions
+    """
+    def key(entry):
+        return entry['suite'], entry['name'], json.dumps(entry['params'], sort_keys=True)
+
+    previous = {key(entry): entry for entry in baseline['results']}
+    regressions = 0
+    for entry in results:
+        old = previous.get(key(entry))
+        if old is None or not old['seconds']['median']:
+            continue
+        ratio = entry['seconds']['median'] / old['seconds']['median']
+        flag = ""
+        if ratio > REGRESSION:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{entry['suite']:9} {entry['name']:22} {json.dumps(entry['params']):40} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+@click.command()
+@click.option('--quick', is_flag=True, help="Smaller payloads and vaults, and fewer repeats.")
+@click.option('--suite', 'suites', multiple=True, type=click.Choice(['crypto', 'vault', 'transfer', 'startup']),
+              help="Only run the given suites.  [default: all]")
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help="Write the results to this JSON file.")
+@click.option('--compare', 'baseline', type=click.File(), help="JSON results of an earlier run to compare with.")
+def main(quick, suites, output, baseline):
+    """
+    Runs the benchmarks and prints or writes their results as JSON.
+    """
+    repeat = QUICK_REPEAT if quick else REPEAT
+    suites = suites or ('crypto', 'vault', 'transfer', 'startup')
+
+    results = []
+    if 'crypto' in suites:
+        results += bench_crypto(QUICK_PAYLOAD_SIZES if quick else PAYLOAD_SIZES, repeat)
+    if 'vault' in suites:
+        results += bench_vault(QUICK_VAULT_SIZES if quick else VAULT_SIZES, repeat)
+        results += bench_legacy_unlock(QUICK_LEGACY_RECORDS if quick else LEGACY_RECORDS, repeat)
+    if 'transfer' in suites:
+        results += bench_transfer(QUICK_TRANSFER_SIZES if quick else TRANSFER_SIZES, repeat)
+    if 'startup' in suites:
+        results += bench_startup(repeat)
+
+    report = {'environment': _environment(), 'quick': quick, 'results': results}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    failed = False
+    for entry in results:
+        if entry.get('heavy_imports'):
+            print(f"cfe {entry['name']} imports {', '.join(entry['heavy_imports'])} on startup", file=sys.stderr)
+            failed = True
+    if baseline is not None and compare(results, json.load(baseline)):
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def _vault(n):
+    """
+    Returns a vault in the current directory holding n uploaded entries
+    """
+    os.makedirs(os.path.dirname(vault.VAULT_PATH), exist_ok=True)
+    open(vault.VAULT_PATH, 'wb').close()
+    v = vault.Vault(PASSWORD)
+    entries = []
+    for i in range(n):
+        entry = vault.VaultEntry(f"bench/{i % 10}/file-{i:06d}", f"guid-{i}")
+        entry.file_id, entry.size, entry.checksum = f"id-{i}", 1024 + i, os.urandom(16).hex()
+        entries.append(entry)
+    v.add_data(entries)
+    return v
+
+
+def _run(*args):
+    with mock.patch.object(cli_main, 'getpass', lambda prompt="": PASSWORD):
+        outcome = CliRunner().invoke(cli_main.cli, args, catch_exceptions=False)
+    if outcome.exit_code != 0:
+        raise RuntimeError(f"cfe {' '.join(args)} failed: {outcome.output}")
+
+
+def _cfe(args, env, *options):
+    """
+    Runs cfe with args in a new interpreter started with options
+    """
+    outcome = subprocess.run([sys.executable, *options, '-m', 'cfe', *args], env=env, capture_output=True,
+                             text=True, stdin=subprocess.DEVNULL)
+    if outcome.returncode != 0:
+        raise RuntimeError(f"cfe {' '.join(args)} failed: {outcome.stderr}")
+    return outcome
+
+
+def _import_times(output):
+    """
+    Returns the module name, cumulative import time in microseconds and
+    nesting depth of every import listed by python -X importtime
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit():
+            # Nested imports are indented by two spaces per level
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            imports.append((name.strip(), int(cumulative), depth))
+    return imports
+
+
+@contextlib.contextmanager
+def _workdir():
+    # The vault and provider settings live relative to the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="cfe-bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            yield workdir
+        finally:
+            os.chdir(cwd)
+
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'cryptography': cryptography.__version__,
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,137 @@
+import base64
 import cmd
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
+import io
 import os
+import queue
+import tempfile
+import threading
 import uuid
 from getpass import getpass
 
 import click
 import logging
-import tqdm
 
-from .drive_api import auth
-from .drive_api import func
+from . import agent
+from . import chunking
+from . import compression
+from . import stats
+from .checkpoint import Checkpoint
+from .lazy import lazy_import, load
 from .paths import is_path_exists_or_creatable
-from .vault import crypto
-from .vault import storage as vault
+from .pipeline import Pipeline
 
-gigabyte_size = 1073741824
+# Loaded by the commands that use them, so that help, init and the commands
+# the agent runs start without them
+tqdm = lazy_import('tqdm')
+providers = lazy_import('.providers', __package__)
+crypto = lazy_import('.vault.crypto', __package__)
+vault = lazy_import('.vault.storage', __package__)
 
 
-@click.group()
-def cli():
+# Commands that run in the agent when one is running
+FORWARDED = {'upload', 'upload-dir', 'backup', 'download', 'restore', 'list', 'delete', 'gc'}
+# Chunks of a chunked file transferred at the same time
+CHUNK_JOBS = 8
+
+# The vault unlocked by the agent, set in the agent process only
+_agent_vault = None
+
+
+class _Cli(click.Group):
+    def parse_args(self, ctx, args):
+        # Kept for handing the command line over to the agent. Note that
+        # list is the command of that name in this module
+        ctx.meta['cfe.argv'] = [*args]
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=_Cli)
+@click.option('--stats', 'show_stats', is_flag=True, envvar='CFE_STATS',
+              help="Print per-phase timings, byte counts and throughput as JSON to stderr when done.")
+@click.option('--no-agent', is_flag=True, envvar='CFE_NO_AGENT', help="Run the command here even if an agent is running.")
+@click.pass_context
+def cli(ctx, show_stats, no_agent):
     """
     Instantiates the CLI application.
     """
-    pass
+    if _agent_vault is None and not no_agent and ctx.invoked_subcommand in FORWARDED:
+        argv = ctx.meta['cfe.argv']
+        if show_stats and '--stats' not in argv:
+            argv = ['--stats'] + argv
+        code = agent.forward(argv)
+        if code is not None:
+            ctx.exit(code)
+
+    if show_stats:
+        stats.enable()
+        ctx.call_on_close(stats.emit)
 
 
 @click.command()
-def init():
+@click.option('--kdf-target-ms', type=click.IntRange(min=1),
+              help="Pick the key derivation parameters that take about this long to unlock the vault on this host.  "
+                   "[default: scrypt n=2^14, r=8, p=1]")
+def init(kdf_target_ms):
     """
     Initializes a CFE vault.
     """
     # Create a folder where the CFE metadata will be stored
     if os.path.exists('vault/cfe_vault.dat'):
+        if kdf_target_ms is not None and os.path.getsize('vault/cfe_vault.dat'):
+            logging.error("Error: The vault already exists, use 'cfe rekey' to change its key derivation parameters")
+            return
         os.utime('vault/cfe_vault.dat', None)
     else:
-        os.mkdir('vault')
+        os.makedirs('vault', exist_ok=True)
         open('vault/cfe_vault.dat', 'a').close()
 
+    if kdf_target_ms is not None:
+        kdf = crypto.calibrate_kdf(kdf_target_ms)
+        vault.create_vault(kdf)
+        print(f"Key derivation: {_describe_kdf(kdf)}")
+
+
+@click.command()
+@click.option('--kdf-target-ms', type=click.IntRange(min=1),
+              help="Pick the key derivation parameters that take about this long to unlock the vault on this host.  "
+                   "[default: scrypt n=2^14, r=8, p=1]")
+def rekey(kdf_target_ms):
+    """
+    Derives the vault key anew with a fresh salt and new key derivation parameters, and reseals all files under it.
+    """
+    v = _open_vault()
+    kdf = crypto.calibrate_kdf(kdf_target_ms) if kdf_target_ms is not None else crypto.DEFAULT_KDF
+    if not v.rekey(kdf):
+        logging.error("Error: The vault also holds files of other passwords, which would become unreadable")
+        return
+    print(f"Key derivation: {_describe_kdf(kdf)}")
+
 
 @click.command()
 @click.argument('add_type')
 @click.argument('name')
-def add(add_type, name):
+@click.option('--root', help="Directory the local provider keeps files in.")
+def add(add_type, name, root):
     """
     Given a type of entity and a label of the entity, adds the entity with the label to the CFE application.
+    Providers are drive and local.
     """
     # Check if they are trying to add a provider
-    # TODO: add login by name
     if add_type == "provider":
-        auth.drive_login()
-        func.init_folder(".cfe")
+        selectable = [provider for provider in providers.PROVIDERS if provider not in providers.EPHEMERAL]
+        if name in providers.EPHEMERAL:
+            logging.error(f"Error: The {name} provider loses its files when the command exits, "
+                          f"expected one of {', '.join(selectable)}")
+            return
+        if name not in providers.PROVIDERS:
+            logging.error(f"Error: Unknown provider '{name}', expected one of {', '.join(selectable)}")
+            return
+        options = {'root': os.path.abspath(root)} if root and name == 'local' else {}
+        providers.select(name, **options)
 
         print("Adding", name)
     else:
@@ -58,75 +141,215 @@ def add(add_type, name):
 @click.command()
 @click.argument('src')
 @click.argument('dst')
-def upload(src, dst):
+@click.option('--resume', is_flag=True, help="Continue an interrupted upload of src to dst.")
+@click.option('--chunk-jobs', type=click.IntRange(min=1), default=CHUNK_JOBS, show_default=True,
+              help="Number of chunks of a chunked file uploaded at the same time.")
+@click.option('--dedup', is_flag=True, help="Do not upload content that is already stored under another name.")
+@click.option('--compress', type=click.Choice(['auto', 'zlib', 'none']), default='auto', show_default=True,
+              help="Compress before encrypting; auto skips files that do not compress well.")
+@click.option('--chunked', is_flag=True,
+              help="Store the file as content-defined chunks, so that uploading it again after it changed only "
+                   "sends the chunks that changed.")
+def upload(src, dst, resume, chunk_jobs, dedup, compress, chunked):
     """
     Uploads a local file at src at the given alias destination.
+    Chunked files are updated in place when uploaded to the same destination again.
     """
     # TODO: Validate if the provider exists
     if not is_path_exists_or_creatable(src):
         logging.error(f"invalid path: {src}")
         return
 
-    # Read the contents of the file
-    content = None
+    # Make sure that the file can be read. The contents are streamed
+    # segment by segment during the upload, so there is no size limit
     try:
-        with open(src, 'rb') as f:
-            content = f.read()
+        size = os.stat(src).st_size
+        open(src, 'rb').close()
     except Exception as e:
         print(e)
         logging.error(f"Error: Could not find file {src}")
         return
 
-    if content is None:
-        logging.error(f"Error: Could not find file {src}")
-        return
+    # Worker threads use these, which have to be loaded before any starts, see lazy.load
+    load(tqdm, providers, crypto, vault)
 
-    # If it's a file, make sure that the file is not too large
-    if os.stat(src).st_size >= gigabyte_size:
-        logging.error(f"file exceeds 1GiB: {src}")
+    # Create a vault entries
+    v = _open_vault(confirm=True)
+    entry = v.get_data(dst)
+    chunked = chunked or (entry is not None and entry.chunked)
+
+    if resume:
+        # Pick up the checkpoint left behind by the interrupted upload
+        if chunked:
+            logging.error(f"Chunked uploads need no --resume, upload {src} to {dst} again to continue")
+            return
+        if entry is None:
+            logging.error(f"No interrupted upload for {dst}")
+            return
+        guid = entry.guid
+        checkpoint = Checkpoint.for_name(guid)
+        if not checkpoint.exists():
+            logging.error(f"No interrupted upload for {dst}")
+            return
+        if checkpoint.get('size') != size or checkpoint.get('mtime') != os.stat(src).st_mtime:
+            logging.error(f"{src} changed since the upload started")
+            return
+        salt = base64.b64decode(checkpoint.get('salt'))
+        # The plaintext has to be compressed exactly as before
+        method = checkpoint.get('compression', compression.NONE)
+    elif entry is not None and not entry.chunked:
+        logging.error(f"Already an entry for {dst}")
         return
+    else:
+        guid = entry.guid if entry is not None else str(uuid.uuid4())
+        checkpoint = Checkpoint.for_name(guid)
+        salt = None
+        method = None if compress == 'auto' else compression.METHODS[compress]
 
-    # Get the password and have the user reconfirm it
-    password = getpass(prompt="Enter password for encryption:")
-    retyped_password = getpass(prompt="Confirm your password:")
-
-    # If the password and the retyped password don't match, have the user retype the pairs
-    # until they match
-    while password != retyped_password:
-        logging.warning('Passwords do not match. Please try again.\n')
-
-        password = getpass(prompt="Enter password for encryption:")
-        retyped_password = getpass(prompt="Confirm your password:")
-
-    # Create a vault entries
-    v = vault.Vault(password)
+    content_mac = None
+    if dedup:
+        with open(src, 'rb') as f:
+            content_mac = v.get_content_mac(f)
+        stored = v.find_content(content_mac)
+        if stored is not None and entry is None:
+            v.link_data(dst, stored)
+            logging.info(f"Content already stored as {stored.nickname}, not uploading it again")
+            return
 
-    if v.get_data(f"{dst} ") is not None:
-        logging.error(f"Already an entry for {dst}")
+    if chunked:
+        _upload_chunked_entry(v, entry, src, dst, guid, size, chunk_jobs, method, content_mac)
         return
 
-    with tqdm.tqdm(total=100) as progress_bar:
-        guid = str(uuid.uuid4())
-        entry = v.create_data(f"{dst} {guid}")
+    if entry is None:
+        # The checkpoint goes first, so that the entry of an upload that is
+        # interrupted at any point can be resumed
+        salt, method = _checkpoint_upload(checkpoint, src, size, method)
+        entry = v.create_data(dst, guid)
 
-        progress_bar.update(33)  # Increment progress bar by 33%
+    # Counts the ciphertext bytes the provider has stored
+    with tqdm.tqdm(desc=dst, unit="B", unit_scale=True) as progress_bar:
+        def progress(done, total):
+            progress_bar.total = total
+            progress_bar.update(done - progress_bar.n)
 
-        # Encrypt the data
-        cipher = crypto.encrypt(entry.entry_key, content)
+        try:
+            _upload_file(entry, src, size, checkpoint, salt, method, progress)
+        except OSError as e:
+            # Transport errors of every provider, including failed resumable uploads
+            logging.error(f"Could not upload {dst}: {e}. Run 'cfe upload --resume {src} {dst}' to continue")
+            return
 
-        progress_bar.update(34)  # Increment progress bar by 34%
+    # Remember where the file went, so that it can be fetched by id later
+    entry.content_mac = content_mac
+    v.update_data(entry)
+    logging.info(f"Successfully uploaded file as {guid}.enc")
 
-        # Upload it to the cloud
-        func.file_upload(guid + ".enc", cipher.decode(), ['.cfe'])
-        logging.info(f"Successfully uploaded file as {guid}.enc")
 
-        progress_bar.update(33)  # Increment progress bar by 33%
+@click.command(name='upload-dir')
+@click.argument('src')
+@click.argument('dst', required=False)
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=8, show_default=True,
+              help="Number of files uploaded at the same time.")
+@click.option('--commit-every', default=100, show_default=True,
+              help="Number of uploaded files after which the vault is saved.")
+@click.option('--dedup', is_flag=True, help="Do not upload content that is already stored under another name.")
+@click.option('--compress', type=click.Choice(['auto', 'zlib', 'none']), default='auto', show_default=True,
+              help="Compress before encrypting; auto skips files that do not compress well.")
+def upload_dir(src, dst, jobs, commit_every, dedup, compress):
+    """
+    Uploads every file below the local directory src, named dst/<relative path>.
+    Files whose name is already in the vault are skipped.
+    """
+    if not os.path.isdir(src):
+        logging.error(f"invalid directory: {src}")
+        return
+    if dst is None:
+        dst = os.path.basename(os.path.abspath(src))
+
+    # Worker threads use these, which have to be loaded before any starts, see lazy.load
+    load(tqdm, providers, crypto, vault)
+    v = _open_vault(confirm=True)
+
+    # Walk the tree once up front
+    files = []
+    for root, _, names in os.walk(src):
+        for name in names:
+            path = os.path.join(root, name)
+            nickname = "/".join([dst] + os.path.relpath(path, src).split(os.sep))
+            if v.get_data(nickname) is not None:
+                continue
+            try:
+                files.append((path, nickname, os.stat(path).st_size))
+            except OSError as e:
+                logging.error(f"Could not read {path}: {e}")
+
+    # Guards the vault and the content macs being uploaded, which are shared
+    # by the workers deduplicating content
+    lock = threading.Lock()
+    uploading = set()
+    # (nickname, content mac) of files whose content is uploaded under another name in this run
+    duplicates = []
+
+    method = None if compress == 'auto' else compression.METHODS[compress]
+
+    def upload_one(path, nickname, size):
+        entry = vault.VaultEntry(nickname, str(uuid.uuid4()))
+        if dedup:
+            with open(path, 'rb') as f:
+                entry.content_mac = v.get_content_mac(f)
+            with lock:
+                stored = v.find_content(entry.content_mac)
+                if stored is not None:
+                    return stored.link(nickname)
+                if entry.content_mac in uploading:
+                    duplicates.append((nickname, entry.content_mac))
+                    return None
+                uploading.add(entry.content_mac)
+        _upload_file(entry, path, size, Checkpoint(), method=method)
+        return entry
+
+    # Entries are only written to the vault in batches, once their files are uploaded
+    pending = []
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool, \
+            tqdm.tqdm(total=len(files), unit="file") as progress_bar:
+        futures = {pool.submit(upload_one, *file): file for file in files}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future][0]
+            try:
+                entry = future.result()
+                if entry is not None:
+                    pending.append(entry)
+            except Exception as e:
+                logging.error(f"Could not upload {path}: {e}")
+                failed += 1
+            if len(pending) >= commit_every:
+                with lock:
+                    v.add_data(pending)
+                pending = []
+            progress_bar.update(1)
+    v.add_data(pending)
+
+    # Files sharing their content with another file of this run refer to its upload
+    links = []
+    for nickname, content_mac in duplicates:
+        stored = v.find_content(content_mac)
+        if stored is None:
+            logging.error(f"Could not upload {nickname}: the upload of the same content failed")
+            failed += 1
+        else:
+            links.append(stored.link(nickname))
+    v.add_data(links)
+
+    logging.info(f"Uploaded {len(files) - failed} of {len(files)} files from {src}")
 
 
 @click.command()
 @click.argument('src')
 @click.argument('dst')
-def download(src, dst):
+@click.option('--chunk-jobs', type=click.IntRange(min=1), default=CHUNK_JOBS, show_default=True,
+              help="Number of chunks of a chunked file downloaded at the same time.")
+def download(src, dst, chunk_jobs):
     """
     Downloads the file at src with and saves it at the local location at dst.
     """
@@ -141,62 +364,140 @@ def download(src, dst):
         if not click.confirm("Do you want to overwrite this file?", default=False):
             return
 
+    # Worker threads use these, which have to be loaded before any starts, see lazy.load
+    load(tqdm, providers, crypto, vault)
+
     # Get the file ID
-    password = getpass(prompt="Enter password for encryption:")
-    v = vault.Vault(password)
-    entry = v.get_data(src + " ")
+    v = _open_vault()
+    entry = v.get_data(src)
 
-    with tqdm.tqdm(total=100) as progress_bar:
-        if entry is None:
-            logging.error(f"No metdata found on {src}")
-            return
+    if entry is None:
+        logging.error(f"No metdata found on {src}")
+        return
 
-        progress_bar.update(33)  # Increment progress bar by 33%
+    key = entry.get_key()
+    nickname = entry.nickname
+    remote_name = entry.guid
+
+    if entry.chunked:
+        with tqdm.tqdm(total=entry.size, desc=nickname, unit="B", unit_scale=True) as progress_bar:
+            try:
+                _download_chunked(entry, dst, chunk_jobs, progress_bar)
+            except crypto.InvalidToken:
+                logging.error(f"Could not decrypt {nickname}")
+                return
+            except Exception as e:
+                logging.error(f"Could not download {nickname}: {e}")
+                return
+        logging.info(f"Successfully downloaded {dst}")
+        return
 
-        key = entry.get_key()
-        data = entry.get_name().split()
-        nickname = data[0].strip()
-        remote_name = data[1].strip()
+    # Download the file
+    try:
+        chunks = providers.get().download(remote_name + ".enc", file_id=entry.file_id)
+    except:
+        logging.error(f"Could not find {nickname}")
+        return
 
-        # Download the file
-        cipher = None
+    # Decrypt the file as it arrives and write it to dst, counting the ciphertext bytes received
+    with tqdm.tqdm(total=entry.size, desc=nickname, unit="B", unit_scale=True) as progress_bar:
         try:
-            cipher = func.file_download(remote_name + ".enc", ['.cfe'], dst)
-        except:
-            logging.error(f"Could not find {nickname}")
+            _decrypt_to_file(key, _counted(chunks, progress_bar), dst)
+        except crypto.InvalidToken:
+            logging.error(f"Could not decrypt {nickname}")
             return
-
-        if cipher is None:
-            logging.error(f"Could not find {nickname}")
+        except Exception as e:
+            logging.error(f"Could not download {nickname}: {e}")
             return
 
-        progress_bar.update(34)  # Increment progress bar by 34%
+    logging.info(f"Successfully downloaded {dst}")
 
-        # Decrypt the file and write to dst
-        plaintext = crypto.decrypt(key, cipher)
-        with open(dst, "wb") as f:
-            f.write(plaintext)
 
-        logging.info(f"Successfully downloaded {dst}")
+@click.command()
+@click.argument('pattern')
+@click.argument('dst')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=8, show_default=True,
+              help="Number of files downloaded at the same time.")
+@click.option('--overwrite', is_flag=True, help="Replace files that already exist below dst.")
+def restore(pattern, dst, jobs, overwrite):
+    """
+    Downloads every file whose name matches the glob or prefix pattern into the local directory dst.
+    """
+    # Worker threads use these, which have to be loaded before any starts, see lazy.load
+    load(tqdm, providers, crypto, vault)
+    v = _open_vault()
+
+    # Narrow the candidates down to the literal prefix of the pattern with the vault index
+    glob = any(c in pattern for c in "*?[")
+    prefix = pattern[:min([pattern.find(c) for c in "*?[" if c in pattern] + [len(pattern)])]
+    entries = [entry for entry in v.get_data_list(prefix)
+               if not glob or fnmatch.fnmatchcase(entry.nickname, pattern)]
+    if not entries:
+        logging.error(f"No files match {pattern}")
+        return
 
-        progress_bar.update(33)  # Increment progress bar by 33%
+    jobs_to_run = []
+    root = os.path.abspath(dst)
+    for entry in entries:
+        target = os.path.normpath(os.path.join(root, *entry.nickname.split("/")))
+        if os.path.commonpath([root, target]) != root or target == root:
+            logging.error(f"Skipping {entry.nickname}: it would be restored outside of {dst}")
+        elif os.path.exists(target) and not overwrite:
+            logging.warning(f"Skipping {entry.nickname}: {target} already exists")
+        else:
+            jobs_to_run.append((entry, target))
+
+    # Entries uploaded before file ids were recorded are looked up with a single listing
+    file_ids = {}
+    if any(entry.file_id is None and not entry.chunked for entry, _ in jobs_to_run):
+        file_ids = {file.name: file.id for file in providers.get().list()}
+
+    # Every worker draws its own line for a per-file progress bar
+    slots = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot + 1)
+
+    def restore_one(entry, target, total_bar):
+        slot = slots.get()
+        try:
+            with tqdm.tqdm(total=entry.size, desc=entry.nickname, unit="B", unit_scale=True,
+                           position=slot, leave=False) as file_bar:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if entry.chunked:
+                    _download_chunked(entry, target, None, file_bar, total_bar)
+                    return
+                file_id = entry.file_id or file_ids.get(entry.guid + ".enc")
+                chunks = providers.get().download(entry.guid + ".enc", file_id=file_id)
+                _decrypt_to_file(entry.get_key(), _counted(chunks, file_bar, total_bar), target)
+        finally:
+            slots.put(slot)
+
+    failed = 0
+    total = sum(entry.size or 0 for entry, _ in jobs_to_run)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool, \
+            tqdm.tqdm(total=total, unit="B", unit_scale=True, position=0) as total_bar:
+        futures = {pool.submit(restore_one, entry, target, total_bar): entry for entry, target in jobs_to_run}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Could not restore {futures[future].nickname}: {e}")
+                failed += 1
+
+    logging.info(f"Restored {len(jobs_to_run) - failed} of {len(jobs_to_run)} files into {dst}")
 
 
 @click.command()
-def list():
+@click.option('--prefix', default="", help="Only list files whose name starts with prefix.")
+def list(prefix):
     """
     Lists all the files associated with a particular password.
     """
     # Prompt the user for a password
-    password = getpass(prompt="Enter password for encryption:")
-    v = vault.Vault(password)
+    v = _open_vault()
 
-    tmp = []
-    for entry in v.get_data_list():
-        data = entry.get_name().split()
-        tmp.append(data[0].strip())
-
-    tmp = sorted(tmp)
+    # Entries come back sorted by nickname
+    tmp = [entry.nickname for entry in v.get_data_list(prefix)]
     cmd.Cmd().columnize(tmp, displaywidth=80)
 
 
@@ -207,43 +508,497 @@ def delete(filename):
     Deletes a file in the vault with the given password.
     """
     # Get the file ID
-    password = getpass(prompt="Enter password for encryption:")
-    v = vault.Vault(password)
-    entry = v.get_data(filename + " ")
+    v = _open_vault()
+    entry = v.get_data(filename)
 
     if entry is None:
         logging.error(f"No metadata found on {filename}")
         return
 
-    with tqdm.tqdm(total=100) as progress_bar:
-        key = entry.get_key()
-        data = entry.get_name().split()
-        nickname = data[0].strip()
-        remote_name = data[1].strip()
-        # Delete the file
+    nickname = entry.nickname
+    remote_name = entry.guid
+    # Delete the file, unless other entries still refer to it
+    if v.get_references(entry) > 1:
+        logging.info(f"{nickname} shares its content with other files, keeping the remote file")
+    elif entry.chunked:
+        # The chunks go first, so that a failure leaves the manifest to find them by
+        try:
+            chunks = _chunk_files(entry)
+        except Exception as e:
+            logging.error(f"Could not read the manifest of {nickname}: {e}")
+            return
+        _delete_remote(chunks)
+        if entry.file_id is not None:
+            _delete_remote([(remote_name + ".enc", entry.file_id)])
+        Checkpoint.for_name(remote_name).remove()
+    else:
         try:
-            func.file_delete(remote_name + ".enc", ['.cfe'])
-        except:
-            logging.error(f"Could not find {nickname}")
+            providers.get().delete(remote_name + ".enc", file_id=entry.file_id)
+        except FileNotFoundError:
+            # Nothing was stored, such as by an upload that did not complete
+            logging.warning(f"Could not find the remote file of {nickname}, deleting its entry only")
+        except Exception as e:
+            logging.error(f"Could not delete {nickname}: {e}")
             return
+        Checkpoint.for_name(remote_name).remove()
+
+    success = v.delete_data(filename)
+    if not success:
+        logging.error(f"Could not find {nickname}")
+
+    logging.info(f"Successfully deleted {filename}")
+
+
+@click.command()
+def gc():
+    """
+    Deletes the remote chunks of chunked files that no manifest lists any more, such as those of replaced files or
+    those an interrupted upload stored without recording them. Chunks that the checkpoint of an unfinished upload
+    records are kept for when it continues. Only files of the vault entries of the password are considered.
+    """
+    v = _open_vault()
+    entries = {entry.guid: entry for entry in v.get_data_list() if entry.chunked}
+    listed = {}
+    stale = []
+    for file in providers.get().list():
+        guid = chunking.chunk_owner(file.name)
+        if guid is None:
+            # Providers that keep files of the same name apart may hold older manifests
+            entry = entries.get(file.name[:-len(".enc")]) if file.name.endswith(".enc") else None
+            if entry is not None and entry.file_id is not None and file.id != entry.file_id:
+                stale.append((file.name, file.id))
+            continue
+        if guid not in entries:
+            continue
+        if guid not in listed:
+            entry = entries[guid]
+            listed[guid] = {chunk.id for chunk in _read_manifest(entry).chunks} if entry.file_id else set()
+            # An upload that did not complete continues with these
+            listed[guid] |= {chunk.id for chunk in _checkpointed_chunks(Checkpoint.for_name(guid))}
+        if file.id not in listed[guid]:
+            stale.append((file.name, file.id))
+
+    logging.info(f"Deleted {_delete_remote(stale)} unreferenced files")
+
+
+@click.command(name='agent')
+@click.option('--idle-timeout', default=agent.IDLE_TIMEOUT, show_default=True,
+              help="Seconds without commands after which the agent exits.")
+@click.option('--foreground', is_flag=True, help="Serve in this process instead of in the background.")
+@click.option('--stop', is_flag=True, help="Stop the running agent.")
+def run_agent(idle_timeout, foreground, stop):
+    """
+    Unlocks the vault once and keeps it, with the provider session, in a background process that
+    runs the upload, download, restore, list and delete commands issued from this directory.
+    """
+    global _agent_vault
+    if not agent.available():
+        logging.error("Error: The agent needs Unix domain sockets, which this platform lacks")
+        return
+    if stop:
+        if not agent.stop():
+            logging.error("No agent is running")
+        return
+
+    # Forwarded uploads seal entries under this password, so it is typed twice like for a direct upload
+    v = vault.Vault(_confirm_password())
+    try:
+        server = agent.Agent(_run_in_agent, idle_timeout=idle_timeout)
+    except (OSError, RuntimeError) as e:
+        logging.error(f"Error: Could not start the agent: {e}")
+        return
+    _agent_vault = v
+    print(f"Agent listening at {agent.SOCKET_PATH}")
+    server.serve(detach=not foreground)
+
+
+def _run_in_agent(argv):
+    """
+    Runs a forwarded command line against the vault of the agent and returns its exit code.
+    """
+    # Another process may have changed the vault since the last command
+    _agent_vault.refresh()
+    try:
+        cli.main(args=argv, prog_name='cfe', standalone_mode=False)
+    except click.exceptions.Exit as e:
+        return e.exit_code
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        click.echo("Aborted!", err=True)
+        return 1
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    return 0
+
+
+def _open_vault(confirm=False):
+    """
+    Returns the vault unlocked by the agent the command runs in, or prompts
+    for the password, twice if confirm is set, and unlocks the vault.
+    """
+    if _agent_vault is not None:
+        return _agent_vault
+    if confirm:
+        return vault.Vault(_confirm_password())
+    return vault.Vault(getpass(prompt="Enter password for encryption:"))
 
-        progress_bar.update(50)  # Increment progress bar by 50%
 
-        success = v.delete_data(filename)
-        if not success:
-            logging.error(f"Could not find {nickname}")
+def _describe_kdf(kdf):
+    return f"scrypt n=2^{kdf.n.bit_length() - 1}, r={kdf.r}, p={kdf.p} ({kdf.memory() // (1024 * 1024)} MiB)"
+
+
+def _confirm_password():
+    """
+    Prompts for a password until it is typed the same way twice.
+    """
+    # Get the password and have the user reconfirm it
+    password = getpass(prompt="Enter password for encryption:")
+    retyped_password = getpass(prompt="Confirm your password:")
+
+    # If the password and the retyped password don't match, have the user retype the pairs
+    # until they match
+    while password != retyped_password:
+        logging.warning('Passwords do not match. Please try again.\n')
+
+        password = getpass(prompt="Enter password for encryption:")
+        retyped_password = getpass(prompt="Confirm your password:")
+
+    return password
+
+
+def _upload_file(entry, src, size, checkpoint, salt=None, method=None, progress=None):
+    """
+    Encrypts the file at src segment by segment while uploading it as the
+    remote file of entry, and records where it went in the entry.
+    The file is compressed first with the given method, or with the one
+    that suits a sample of the file if method is None.
+    progress, if given, is called with the ciphertext bytes stored so far
+    and the total.
+    """
+    # The salt is checkpointed, so a resumed upload re-creates exactly the
+    # same ciphertext stream from the last acknowledged chunk onwards
+    if salt is None:
+        salt, method = _checkpoint_upload(checkpoint, src, size, method)
+    with open(src, 'rb') as f, tempfile.TemporaryFile() as spool:
+        plaintext, plaintext_size = f, size
+        if method != compression.NONE:
+            # The upload has to know its length and be able to seek back on
+            # retries, so the compressed plaintext is spooled to disk first
+            with stats.phase('compress', size):
+                plaintext_size = compression.compress_file(f, spool, method)
+            plaintext = spool
+
+        # Read and encrypt the next upload chunk while the current one is sent
+        backend = providers.get()
+        depth = backend.upload_chunk_size // crypto.SEGMENT_SIZE
+        cipher = crypto.EncryptingReader(entry.entry_key, plaintext, plaintext_size, salt, depth=depth,
+                                         compression=method)
+        total = crypto.encrypted_size(plaintext_size, compression=method)
+        with cipher:
+            stored = backend.upload(entry.guid + ".enc", cipher, checkpoint,
+                                    progress=(lambda done: progress(done, total)) if progress else None,
+                                    segment_size=crypto.SEGMENT_SIZE + crypto.TAG_SIZE,
+                                    header_size=cipher.header_size)
+
+    entry.file_id = stored.id
+    entry.size = stored.size if stored.size is not None else total
+    entry.checksum = stored.checksum
+
+
+def _checkpoint_upload(checkpoint, src, size, method=None):
+    """
+    Picks the salt of the ciphertext stream of the file at src and, if
+    method is None, the compression method that suits a sample of the file,
+    and records both in checkpoint with the size and modification time of
+    the file. Returns the salt and the method.
+    """
+    if method is None:
+        with open(src, 'rb') as f:
+            method = compression.choose(f)
+    salt = os.urandom(crypto.SALT_SIZE)
+    checkpoint.update(size=size, mtime=os.stat(src).st_mtime, salt=base64.b64encode(salt).decode(),
+                      compression=method)
+    return salt, method
+
+
+def _upload_chunked_entry(v, entry, src, dst, guid, size, jobs=None, method=None, content_mac=None):
+    """
+    Uploads the file at src as the chunked file dst of the vault, stored as
+    guid. entry is the current entry of dst, if any, whose chunks are reused
+    where the content did not change and deleted once nothing lists them.
+    The entry is recorded before anything is uploaded and the chunks in its
+    upload checkpoint as they are stored, so that uploading again after a
+    failure continues with the chunks already stored.
+    """
+    if entry is None:
+        entry = vault.VaultEntry(dst, guid)
+        entry.chunked = True
+        v.add_data([entry])
+    elif v.get_references(entry) > 1:
+        # The manifest stays as it is for the other names that share it,
+        # dst refers to a file of its own from now on
+        entry = vault.VaultEntry(dst, str(uuid.uuid4()))
+        entry.chunked = True
+        v.delete_data(dst)
+        v.add_data([entry])
+    checkpoint = Checkpoint.for_name(entry.guid)
+
+    try:
+        with tqdm.tqdm(total=size, desc=dst, unit="B", unit_scale=True) as progress_bar:
+            stale, uploaded, total = _upload_chunked(entry, src, checkpoint, jobs, method, progress_bar.update)
+    except Exception as e:
+        logging.error(f"Could not upload {dst}: {e}. Upload it again to continue")
+        return
 
-        logging.info(f"Successfully deleted {filename}")
+    entry.content_mac = content_mac
+    v.update_data(entry)
+    checkpoint.remove()
+    _delete_remote(stale)
+    logging.info(f"Uploaded {uploaded} of {total} chunks of {dst}")
 
-        progress_bar.update(50)  # Increment progress bar by 50%
+
+def _upload_chunked(entry, src, checkpoint, jobs=None, method=None, progress=None):
+    """
+    Uploads the chunks of the file at src that neither the current manifest
+    of entry nor checkpoint lists, recording each in checkpoint once it is
+    stored, then the new manifest, and records where it went in the entry.
+    progress, if given, is called with the size of every chunk handled.
+    Returns the remote files no longer listed, as (name, id) pairs, the
+    number of chunks uploaded and the number in the file.
+    """
+    previous = _read_manifest(entry) if entry.file_id is not None else chunking.Manifest(0, [])
+    # Chunks stored by an upload that did not complete
+    checkpointed = _checkpointed_chunks(checkpoint)
+    stored = {chunk.mac: chunk for chunk in [*previous.chunks, *checkpointed]}
+    chunker = _chunker(entry)
+
+    def upload_chunk(mac, data):
+        remote = _upload_bytes(entry.get_key(), chunking.chunk_name(entry.guid, mac), data, method)
+        return chunking.Chunk(mac, len(data), remote.id, remote.size)
+
+    def record(future, chunk_size):
+        chunk = future.result()
+        checkpointed.append(chunk)
+        checkpoint.update(chunks=[[*chunk] for chunk in checkpointed])
+        if progress is not None:
+            progress(chunk_size)
+
+    chunks = []
+    # Chunks being uploaded by mac, as a file may repeat one
+    uploading = {}
+    pending = collections.deque()
+    with open(src, 'rb') as f, concurrent.futures.ThreadPoolExecutor(max_workers=jobs or CHUNK_JOBS) as pool:
+        if method is None:
+            method = compression.choose(f)
+        for data in stats.timed('chunk', chunker.split(f)):
+            mac = chunker.mac(data)
+            if mac in stored:
+                chunks.append(stored[mac])
+                if progress is not None:
+                    progress(len(data))
+                continue
+            if mac not in uploading:
+                uploading[mac] = pool.submit(upload_chunk, mac, data)
+                pending.append((uploading[mac], len(data)))
+            chunks.append(uploading[mac])
+            # Bounds the chunks held in memory
+            while len(pending) > 2 * (jobs or CHUNK_JOBS) or (pending and pending[0][0].done()):
+                record(*pending.popleft())
+        for future, chunk_size in pending:
+            record(future, chunk_size)
+
+    chunks = [chunk.result() if isinstance(chunk, concurrent.futures.Future) else chunk for chunk in chunks]
+    manifest = chunking.Manifest(sum(chunk.size for chunk in chunks), chunks).pack()
+    remote = _upload_bytes(entry.get_key(), entry.guid + ".enc", manifest)
+
+    stale = []
+    if entry.file_id is not None and entry.file_id != remote.id:
+        stale.append((entry.guid + ".enc", entry.file_id))
+    listed = {chunk.id for chunk in chunks}
+    stale += [(chunking.chunk_name(entry.guid, chunk.mac), chunk.id)
+              for chunk in {chunk.id: chunk for chunk in [*previous.chunks, *checkpointed]}.values()
+              if chunk.id not in listed]
+    entry.file_id = remote.id
+    entry.size = (remote.size or len(manifest)) + sum(chunk.stored or 0 for chunk in chunks)
+    entry.checksum = remote.checksum
+    return stale, len(uploading), len(chunks)
+
+
+def _download_chunked(entry, dst, jobs=None, *progress_bars):
+    """
+    Downloads the chunks of a chunked file, several at a time, and writes
+    them in order to a temporary file next to dst, which only replaces dst
+    once every chunk has been authenticated.
+    """
+    manifest = _read_manifest(entry, *progress_bars)
+    chunker = _chunker(entry)
+
+    def fetch(chunk):
+        ciphertext = providers.get().download(chunking.chunk_name(entry.guid, chunk.mac), file_id=chunk.id)
+        plaintext = _decrypt_bytes(entry.get_key(), ciphertext)
+        # Every chunk authenticates on its own, so this catches chunks swapped by the provider
+        if chunker.mac(plaintext) != chunk.mac:
+            raise crypto.InvalidToken
+        return plaintext
+
+    jobs = jobs or CHUNK_JOBS
+    with _replacing(dst) as f, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for chunk, plaintext in _in_order(pool, fetch, manifest.chunks, 2 * jobs):
+            with stats.phase('disk_write', len(plaintext)):
+                f.write(plaintext)
+            for progress_bar in progress_bars:
+                progress_bar.update(chunk.stored or 0)
+
+
+def _in_order(pool, function, items, depth):
+    """
+    Yields every item with function(item), computed on the pool with at
+    most depth calls in flight, in the order of items
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append((item, pool.submit(function, item)))
+        if len(pending) >= depth:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def _read_manifest(entry, *progress_bars):
+    """
+    Returns the manifest of a chunked file
+    """
+    chunks = providers.get().download(entry.guid + ".enc", file_id=entry.file_id)
+    return chunking.Manifest.unpack(_decrypt_bytes(entry.get_key(), _counted(chunks, *progress_bars)))
+
+
+def _chunk_files(entry):
+    """
+    Returns the remote chunks of a chunked file as (name, id) pairs. Those
+    of a file whose first upload did not complete are found by listing.
+    """
+    if entry.file_id is None:
+        return [(file.name, file.id) for file in providers.get().list()
+                if chunking.chunk_owner(file.name) == entry.guid]
+    return [(chunking.chunk_name(entry.guid, chunk.mac), chunk.id) for chunk in _read_manifest(entry).chunks]
+
+
+def _checkpointed_chunks(checkpoint):
+    """
+    Returns the chunks that checkpoint records as stored
+    """
+    return [chunking.Chunk(*chunk) for chunk in checkpoint.get('chunks', [])]
+
+
+def _chunker(entry):
+    return chunking.Chunker(base64.urlsafe_b64decode(crypto.derive_subkey(entry.get_key(), None, b"cfe chunking")))
+
+
+def _upload_bytes(key, name, data, method=compression.NONE):
+    """
+    Encrypts data, compressed with method, and uploads it as the remote file name
+    """
+    if method != compression.NONE:
+        compressed = io.BytesIO()
+        with stats.phase('compress', len(data)):
+            compression.compress_file(io.BytesIO(data), compressed, method)
+        data = compressed.getvalue()
+    with crypto.EncryptingReader(key, io.BytesIO(data), len(data), compression=method) as cipher:
+        return providers.get().upload(name, cipher, Checkpoint(),
+                                      segment_size=crypto.SEGMENT_SIZE + crypto.TAG_SIZE,
+                                      header_size=cipher.header_size)
+
+
+def _decrypt_bytes(key, chunks):
+    """
+    Returns the plaintext of the ciphertext chunks of a small remote file
+    """
+    decryptor = crypto.StreamDecryptor(key)
+    plaintext = b"".join(decryptor.update(chunk) for chunk in chunks)
+    return plaintext + decryptor.finalize()
+
+
+def _delete_remote(files):
+    """
+    Deletes the remote files given as (name, id) pairs, leaving those that
+    fail to a later 'cfe gc'. Returns the number deleted.
+    """
+    deleted = 0
+    for name, file_id in files:
+        try:
+            providers.get().delete(name, file_id=file_id)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Could not delete {name}: {e}")
+    return deleted
+
+
+def _decrypt_to_file(key, chunks, dst):
+    """
+    Decrypts the ciphertext chunks into a temporary file next to dst, which
+    only replaces dst once the whole file has been authenticated.
+    """
+    with _replacing(dst) as f:
+        # Fetch, decrypt and write on separate threads, so that the next
+        # chunk downloads while the current one is decrypted and written
+        decryptor = crypto.StreamDecryptor(key)
+        with Pipeline(chunks) as fetched, \
+                Pipeline(decryptor.update(chunk) for chunk in fetched) as decrypted:
+            for plaintext in decrypted:
+                with stats.phase('disk_write', len(plaintext)):
+                    f.write(plaintext)
+        plaintext = decryptor.finalize()
+        with stats.phase('disk_write', len(plaintext)):
+            f.write(plaintext)
+
+
+@contextlib.contextmanager
+def _replacing(dst):
+    """
+    Yields a temporary file next to dst, which replaces dst once the with
+    block completes and is removed if it fails
+    """
+    fd, tmp = tempfile.mkstemp(prefix=".cfe-", dir=os.path.dirname(os.path.abspath(dst)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            with stats.phase('disk_write'):
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, dst)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _counted(chunks, *progress_bars):
+    """
+    Yields the chunks, advancing the progress bars by the size of each
+    """
+    for chunk in chunks:
+        for progress_bar in progress_bars:
+            progress_bar.update(len(chunk))
+        yield chunk
 
 
 cli.add_command(init)
 cli.add_command(add)
 cli.add_command(download)
 cli.add_command(upload)
+cli.add_command(upload_dir)
+cli.add_command(upload_dir, name='backup')
+cli.add_command(restore)
 cli.add_command(list)
 cli.add_command(delete)
+cli.add_command(rekey)
+cli.add_command(gc)
+cli.add_command(run_agent)
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,284 @@
+"""
+Resident process that runs commands against an unlocked vault.
+
+'cfe agent' unlocks the vault once and then serves the commands of later
+'cfe' invocations from the same directory over a Unix socket next to the
+vault, until it has been idle for a while. Those invocations only forward
+their command line and print what comes back, so they pay neither the
+password prompt and key derivation nor the provider login, and the agent's
+folder cache and connections stay warm between them.
+
+The socket is only accessible to its owner. Commands run one at a time, in
+the working directory of the client that sent them, with an empty stdin:
+commands that would prompt, such as a download over an existing file, are
+aborted. Their output and log records, including those of the threads they
+start, go to the client.
+
+Every message is a line of JSON. The client sends {"argv": [...], "cwd": ...}
+or {"stop": true}; the agent answers with any number of {"stdout": text} and
+{"stderr": text} followed by {"exit": code}.
+"""
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+SOCKET_PATH = os.path.join('vault', 'agent.sock')
+IDLE_TIMEOUT = 15 * 60
+# How often the idle timeout is checked
+POLL_INTERVAL = 1.0
+
+
+def available():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def forward(argv, path=SOCKET_PATH):
+    """
+    Runs argv in the agent listening at path, copying its output to this
+    process. Returns the exit code of the command, or None if no agent is
+    listening.
+    """
+    if not available() or not os.path.exists(path):
+        return None
+    try:
+        conn = _connect(path)
+    except OSError:
+        return None
+    with conn, conn.makefile('rb') as replies:
+        _send(conn, {'argv': argv, 'cwd': os.getcwd()})
+        for line in replies:
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            for name, stream in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+                if name in message:
+                    stream.write(message[name])
+                    stream.flush()
+    # The agent went away in the middle of the command
+    return 1
+
+
+def stop(path=SOCKET_PATH):
+    """
+    Asks the agent listening at path to exit. Returns False if there is none.
+    """
+    if not available() or not os.path.exists(path):
+        return False
+    try:
+        with _connect(path) as conn, conn.makefile('rb') as replies:
+            _send(conn, {'stop': True})
+            replies.readline()
+    except OSError:
+        return False
+    return True
+
+
+class Agent:
+    """
+    Serves forwarded command lines with run, a function that executes one
+    and returns its exit code.
+    """
+
+    def __init__(self, run, path=SOCKET_PATH, idle_timeout=IDLE_TIMEOUT):
+        self.run = run
+        self.path = os.path.abspath(path)
+        self.idle_timeout = idle_timeout
+        # Serialises commands
+        self._lock = threading.Lock()
+        # Connections being handled and when the last one finished
+        self._state = threading.Lock()
+        self._active = 0
+        self._last_used = time.monotonic()
+        self._stopping = threading.Event()
+        self._server = self._bind(path)
+
+    def serve(self, detach=False):
+        """
+        Handles connections until stopped or idle for idle_timeout seconds.
+        With detach, this happens in a background process and the call
+        returns right away in the calling one.
+        """
+        if detach and os.fork() != 0:
+            # The child owns the socket from now on
+            self._server.close()
+            return
+        if detach:
+            os.setsid()
+            _redirect_to_devnull()
+        _log_to_stderr()
+
+        try:
+            self._server.settimeout(POLL_INTERVAL)
+            while not self._stopping.is_set():
+                try:
+                    conn, _ = self._server.accept()
+                except socket.timeout:
+                    with self._state:
+                        if not self._active and time.monotonic() - self._last_used > self.idle_timeout:
+                            return
+                    continue
+                with self._state:
+                    self._active += 1
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._server.close()
+            with contextlib.suppress(OSError):
+                os.remove(self.path)
+            if detach:
+                os._exit(0)
+
+    def _handle(self, conn):
+        try:
+            with conn, conn.makefile('rb') as requests:
+                request = json.loads(requests.readline() or 'null')
+                if not request:
+                    return
+                if request.get('stop'):
+                    self._stopping.set()
+                    _send(conn, {'exit': 0})
+                    return
+                # Commands share the vault and the working directory of the process
+                with self._lock:
+                    code = self._run(conn, request['argv'], request['cwd'])
+                _send(conn, {'exit': code})
+        except (OSError, ValueError):
+            # The client went away or sent garbage
+            pass
+        finally:
+            with self._state:
+                self._active -= 1
+                self._last_used = time.monotonic()
+
+    def _run(self, conn, argv, cwd):
+        cwd_before = os.getcwd()
+        stdout, stderr = _Stream(conn, 'stdout'), _Stream(conn, 'stderr')
+        try:
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr), \
+                    _redirect_stdin(io.StringIO()):
+                try:
+                    return self.run(argv)
+                except Exception:
+                    traceback.print_exc()
+                    return 1
+        except OSError as e:
+            logging.error(f"Could not run {' '.join(argv)}: {e}")
+            return 1
+        finally:
+            os.chdir(cwd_before)
+
+    def _bind(self, path):
+        if os.path.exists(path):
+            if _listening(path):
+                raise RuntimeError(f"an agent is already listening at {path}")
+            # Left behind by an agent that did not exit cleanly
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(umask)
+        server.listen()
+        return server
+
+
+class _Stream(io.TextIOBase):
+    """
+    Text stream that sends everything written to it as messages of the given name
+    """
+
+    def __init__(self, conn, name):
+        super().__init__()
+        self._conn = conn
+        self._name = name
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if isinstance(text, (bytes, bytearray)):
+            text = text.decode(self.encoding, 'replace')
+        if text:
+            try:
+                _send(self._conn, {self._name: text})
+            except OSError:
+                # The client went away, the command still finishes
+                pass
+        return len(text)
+
+
+class _StderrHandler(logging.StreamHandler):
+    """
+    Writes log records to sys.stderr as it is when they are emitted, which
+    is the stream of the command being run, rather than as it was when the
+    handler was made
+    """
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, stream):
+        pass
+
+
+def _log_to_stderr():
+    # Otherwise the first log call of a command would bind the root logger
+    # to the stream of that command for the life of the agent
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = _StderrHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+
+
+@contextlib.contextmanager
+def _redirect_stdin(stream):
+    stdin, sys.stdin = sys.stdin, stream
+    try:
+        yield
+    finally:
+        sys.stdin = stdin
+
+
+def _listening(path):
+    try:
+        _connect(path).close()
+    except OSError:
+        return False
+    return True
+
+
+def _connect(path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        raise
+    return conn
+
+
+def _send(conn, message):
+    conn.sendall(json.dumps(message).encode() + b"\n")
+
+
+def _redirect_to_devnull():
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
@@ -0,0 +1,56 @@
+import json
+import os
+from typing import Optional
+
+CHECKPOINT_DIR = os.path.join('vault', 'uploads')
+
+
+class Checkpoint:
+    """
+    progress of one resumable upload, persisted as JSON after every chunk the server acknowledges.
+
+    fields: session (upload session URI), committed (bytes acknowledged), segment (index of the
+    ciphertext segment containing the next byte to send) and anything the caller needs to
+    rebuild the exact same ciphertext stream on resume.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: JSON file the checkpoint is kept in, or None to only track progress in memory
+        """
+        self.path = path
+        self.data = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    @classmethod
+    def for_name(cls, name: str) -> 'Checkpoint':
+        """
+        :param name: remote name the upload is stored under
+        :return: checkpoint of the upload stored under name
+        """
+        return cls(os.path.join(CHECKPOINT_DIR, name + '.json'))
+
+    def exists(self) -> bool:
+        return bool(self.data)
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def update(self, **fields) -> None:
+        self.data.update(fields)
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def remove(self) -> None:
+        self.data = {}
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,156 @@
+"""
+Content-defined chunking of files for delta uploads.
+
+A chunked file is stored as a manifest, the remote file of its entry, that
+lists the chunks of the file in order, and one remote file per chunk. Chunk
+boundaries depend only on the bytes around them, so an edit only changes
+the chunks it touches, and updating the file uploads those chunks and a new
+manifest while the others are reused.
+
+Boundaries follow FastCDC: no cut in the first MIN_SIZE bytes of a chunk, a
+strict cut condition up to AVG_SIZE and a loose one after it, which keeps
+chunk sizes close to AVG_SIZE, and a forced cut at MAX_SIZE. FastCDC's gear
+hash is computed a byte at a time, which pure Python does at a few MB/s, so
+the cut condition is evaluated in two stages instead. A tabulation hash of
+the CANDIDATE_WINDOW bytes ending at every position is computed for a whole
+buffer at once, with bytes.translate and big integer xor, and positions
+where it is zero, one in 256, are candidates. A keyed hash of the WINDOW
+bytes ending at a candidate then decides whether to cut there.
+
+Both hashes are keyed by a secret of the entry, so the chunk sizes of a
+file reveal nothing about its content to anyone without the entry key, and
+chunks are named by a keyed mac of their content.
+"""
+import hashlib
+import hmac
+import json
+from typing import List, NamedTuple, Optional
+
+# Every chunk is a remote file of its own, so chunks are large enough for
+# the cost of a request not to dominate
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+READ_SIZE = 16 * 1024 * 1024
+MANIFEST_VERSION = 1
+
+CANDIDATE_WINDOW = 4
+WINDOW = 48
+# Bits of the window hash of a candidate that have to be zero for a cut.
+# With the candidate hash that makes one cut in 2**22 positions before
+# AVG_SIZE and one in 2**18 after it.
+_STRICT_MASK = (1 << 14) - 1
+_LOOSE_MASK = (1 << 10) - 1
+
+
+class Chunk(NamedTuple):
+    """
+    A chunk of a file as listed in its manifest: the keyed mac and size of
+    the plaintext, and the provider id and size of the stored ciphertext
+    """
+    mac: str
+    size: int
+    id: Optional[str] = None
+    stored: Optional[int] = None
+
+
+class Manifest(NamedTuple):
+    """
+    The size of a chunked file and its chunks in order
+    """
+    size: int
+    chunks: List[Chunk]
+
+    def pack(self):
+        return json.dumps({'version': MANIFEST_VERSION, 'size': self.size,
+                           'chunks': [[*chunk] for chunk in self.chunks]}).encode()
+
+    @classmethod
+    def unpack(cls, data):
+        manifest = json.loads(data)
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError(f"unsupported manifest version {manifest.get('version')}")
+        return cls(manifest['size'], [Chunk(*chunk) for chunk in manifest['chunks']])
+
+
+class Chunker:
+    """
+    Splits files into chunks and names them, keyed by secret
+    """
+
+    def __init__(self, secret):
+        self._mac_key = hmac.digest(secret, b"cfe chunk mac", 'sha256')
+        self._window_key = hmac.digest(secret, b"cfe chunk window", 'sha256')
+        # A table of 256 pseudo-random bytes per byte of the candidate window
+        self._tables = [b"".join(hmac.digest(secret, b"cfe chunk table %d %d" % (k, part), 'sha256')
+                                 for part in range(8))
+                        for k in range(CANDIDATE_WINDOW)]
+
+    def mac(self, chunk):
+        """
+        Returns the keyed mac of the content of chunk, as hex
+        """
+        return hmac.digest(self._mac_key, chunk, 'sha256').hex()[:32]
+
+    def split(self, src):
+        """
+        Yields the chunks of the binary file object src, from its current
+        position to the end
+        """
+        data, candidates, pos, eof = b"", b"", 0, False
+        while True:
+            # Cut only once a whole MAX_SIZE chunk or the rest of the file is buffered
+            if not eof and len(data) - pos < MAX_SIZE:
+                block = src.read(READ_SIZE)
+                eof = not block
+                data, pos = data[pos:] + block, 0
+                candidates = self._candidates(data)
+                continue
+            if pos == len(data):
+                return
+            end = self._cut(data, candidates, pos)
+            yield data[pos:end]
+            pos = end
+
+    def _candidates(self, data):
+        # The tabulation hash of the window ending at every position of data, one byte each
+        size = len(data)
+        value = 0
+        for k, table in enumerate(self._tables):
+            value ^= int.from_bytes(data.translate(table), 'little') << (8 * k)
+        return value.to_bytes(size + CANDIDATE_WINDOW, 'little')[:size]
+
+    def _cut(self, data, candidates, start):
+        # Returns the offset just past the chunk of data that starts at start
+        end = len(data)
+        if end - start <= MIN_SIZE:
+            return end
+        normal = min(start + AVG_SIZE, end)
+        limit = min(start + MAX_SIZE, end)
+        # Windows never reach back past start, so cuts do not depend on the chunk before
+        i = candidates.find(0, start + MIN_SIZE - 1, limit)
+        while i != -1:
+            digest = hashlib.blake2b(data[i - WINDOW + 1:i + 1], digest_size=4, key=self._window_key).digest()
+            if not int.from_bytes(digest, 'little') & (_STRICT_MASK if i < normal else _LOOSE_MASK):
+                return i + 1
+            i = candidates.find(0, i + 1, limit)
+        return limit
+
+
+def chunk_name(guid, mac):
+    """
+    Returns the remote name of the chunk with the given mac of the file stored as guid
+    """
+    return f"{guid}.{mac}.enc"
+
+
+def chunk_owner(name):
+    """
+    Returns the guid of the file that the remote file called name is a chunk
+    of, or None if it is not a chunk
+    """
+    if not name.endswith(".enc"):
+        return None
+    guid, _, mac = name[:-len(".enc")].rpartition(".")
+    return guid if guid and len(mac) == 32 else None
+
@@ -0,0 +1,80 @@
+"""
+Compression of plaintext before it is encrypted.
+
+Text such as logs, CSVs and database dumps shrinks several times under
+zlib, while media and archives are already compressed and would only cost
+CPU time. Whether a file is worth compressing is decided from a sample of
+its first blocks, and the method chosen is recorded in the ciphertext
+header so that downloads know how to undo it.
+"""
+import zlib
+
+NONE = 0
+ZLIB = 1
+METHODS = {'none': NONE, 'zlib': ZLIB}
+
+LEVEL = 6
+BLOCK_SIZE = 64 * 1024
+# Bytes compressed to judge a file, and the ratio they have to beat
+SAMPLE_SIZE = 4 * BLOCK_SIZE
+THRESHOLD = 0.9
+
+
+def choose(src, sample_size=SAMPLE_SIZE):
+    """
+    Returns ZLIB if the first sample_size bytes of the binary file object
+    src compress well enough, and NONE otherwise. src is left where it was.
+    """
+    start = src.tell()
+    sample = src.read(sample_size)
+    src.seek(start)
+    if not sample:
+        return NONE
+    # A fast level is enough to tell text from already compressed data
+    compressed = zlib.compress(sample, 1)
+    return ZLIB if len(compressed) < THRESHOLD * len(sample) else NONE
+
+
+def compress_file(src, dst, method, block_size=BLOCK_SIZE):
+    """
+    Writes the compression of the binary file object src to dst and returns
+    the number of bytes written. The output only depends on the input, so
+    compressing a file again reproduces it exactly.
+    """
+    compressor = _compressor(method)
+    written = 0
+    for block in iter(lambda: src.read(block_size), b""):
+        written += dst.write(compressor.compress(block))
+    written += dst.write(compressor.flush())
+    return written
+
+
+def decompressor(method):
+    """
+    Returns an object whose decompress(data) and flush() methods undo the
+    compression of method one chunk at a time
+    """
+    if method == NONE:
+        return _Identity()
+    if method == ZLIB:
+        return zlib.decompressobj()
+    raise ValueError(f"unknown compression method {method}")
+
+
+def _compressor(method):
+    if method == NONE:
+        return _Identity()
+    if method == ZLIB:
+        return zlib.compressobj(LEVEL)
+    raise ValueError(f"unknown compression method {method}")
+
+
+class _Identity:
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
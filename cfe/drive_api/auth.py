@@ -1,7 +1,13 @@
 import os
+import threading
 
+import httplib2
 import requests
 from pydrive2.auth import GoogleAuth
+from pydrive2.drive import GoogleDrive
+from pydrive2.settings import LoadSettingsFile
+
+from .folders import FolderCache
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 REVOKE = "https://accounts.google.com/o/oauth2/revoke"
@@ -9,22 +15,58 @@ SETTINGS_FILE = os.path.join(DIR_PATH, 'settings.yaml')
 
 
 def drive_login() -> GoogleAuth:
-    cwd = change_dir()  # temp solution until we know what will be the working directory
-
-    gauth = GoogleAuth()
+    gauth = GoogleAuth(settings=_settings())
     gauth.LocalWebserverAuth()
+    return gauth
 
-    os.chdir(cwd)
 
-    return gauth
+class DriveSession:
+    """
+    authenticated drive client shared by every operation of the process. credentials are loaded
+    (and refreshed if needed) once; after that pydrive2 refreshes the access token when it expires
+    and keeps one keep-alive http connection per thread, so concurrent transfers can share a session.
+    """
+
+    _lock = threading.Lock()
+    _instance = None
+
+    def __init__(self):
+        self.gauth = drive_login()
+        self.drive = GoogleDrive(self.gauth)
+
+    @classmethod
+    def get(cls) -> 'DriveSession':
+        """
+        :return: the session of this process, logging in on first use
+        """
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls._lock:
+            cls._instance = None
+
+    def http(self) -> httplib2.Http:
+        """
+        :return: authorized http object of the calling thread, the same one pydrive2 uses for its requests
+        """
+        local = self.gauth.thread_local
+        if not getattr(local, 'http', None):
+            local.http = self.gauth.Get_Http_Object()
+        return local.http
 
 
 def drive_logout() -> None:
-    cwd = change_dir()
+    DriveSession.reset()
+    # Folder ids belong to the account that is logging out
+    FolderCache().clear()
 
-    gauth = GoogleAuth()
-    cred_file = gauth.settings.get("save_credentials_file")
-    token = os.path.join(DIR_PATH, cred_file)
+    gauth = GoogleAuth(settings=_settings())
+    token = gauth.settings.get("save_credentials_file")
     gauth.LoadCredentials()
     if not gauth.access_token_expired:
         print('logging out from the gDrive...')
@@ -32,10 +74,14 @@ def drive_logout() -> None:
                       headers={'Content-type': 'application/x-www-form-urlencoded'})
     os.remove(token)
 
-    os.chdir(cwd)
-
 
-def change_dir() -> str:
-    cwd = os.getcwd()
-    os.chdir(DIR_PATH)
-    return cwd
+def _settings() -> dict:
+    """
+    :return: the settings of settings.yaml, with the client secret and token files resolved against this
+             folder. the working directory is shared by every thread, so it is never changed to find them,
+             and the token has to be found again whenever pydrive2 refreshes it.
+    """
+    settings = LoadSettingsFile(SETTINGS_FILE)
+    for key in ('client_config_file', 'save_credentials_file'):
+        settings[key] = os.path.join(DIR_PATH, settings[key])
+    return settings
@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+CACHE_PATH = os.path.join('vault', 'folders.json')
+
+
+class FolderCache:
+    """
+    persistent map from drive folder paths to folder ids, stored next to the vault. folder ids never
+    change, so once a path is resolved it costs no more round trips until the drive reports the id
+    as gone and the entry is invalidated.
+    """
+
+    def __init__(self, path: str = CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._path_locks: Dict[str, threading.Lock] = {}
+        self._folders: Optional[Dict[str, str]] = None
+
+    def get(self, folder_path: List[str]) -> Optional[str]:
+        """
+        :param folder_path: a list of strings representing the path
+                            from root (exclusive) to the folder (inclusive)
+        :return: cached fid of the folder, or None
+        """
+        with self._lock:
+            return self._load().get(_key(folder_path))
+
+    def put(self, folder_path: List[str], folder_id: str) -> None:
+        with self._lock:
+            self._load()[_key(folder_path)] = folder_id
+            self._store()
+
+    def invalidate(self, folder_path: List[str]) -> None:
+        """
+        forget the folder and every folder below it
+        """
+        key = _key(folder_path)
+        with self._lock:
+            folders = self._load()
+            for cached in [k for k in folders if k == key or k.startswith(key + '/')]:
+                del folders[cached]
+            self._store()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._folders = {}
+            self._store()
+
+    def lock(self, folder_path: List[str]) -> threading.Lock:
+        """
+        :return: lock serialising the resolution of folder_path, so that concurrent callers
+                 do not each create the same folder
+        """
+        with self._lock:
+            return self._path_locks.setdefault(_key(folder_path), threading.Lock())
+
+    def _load(self) -> Dict[str, str]:
+        if self._folders is None:
+            try:
+                with open(self.path) as f:
+                    self._folders = json.load(f)
+            except (OSError, ValueError):
+                self._folders = {}
+        return self._folders
+
+    def _store(self) -> None:
+        # The cache is only an optimisation, so failing to persist it is not an error
+        try:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._folders, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+
+def _key(folder_path: List[str]) -> str:
+    return '/'.join(folder_path)
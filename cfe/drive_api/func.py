@@ -1,9 +1,22 @@
-from typing import List, Tuple
+import io
+from typing import BinaryIO, Callable, Iterator, List, Optional, TypeVar, Union
+import httplib2
 from pydrive2.drive import GoogleDrive
-from .auth import drive_login
+from pydrive2.files import ApiRequestError
+from .. import stats
+from ..checkpoint import Checkpoint
+from .auth import DriveSession
+from .folders import FolderCache
+from .resumable import ResumableUpload, ResumableUploadError
 
 FOLDER_TYPE = 'application/vnd.google-apps.folder'
 MIME = 'mimeType'
+CHUNK_SIZE = 4 * 1024 * 1024
+MEDIA_URL = "https://www.googleapis.com/drive/v2/files/{}?alt=media"
+
+T = TypeVar('T')
+
+_folders = FolderCache()
 
 
 def init_folder(folder_name: str) -> str:
@@ -19,59 +32,131 @@ def file_list(folder_path: List[str]) -> list:
     :return: list of GoogleDriveFile objects from which metadata like f['title'] and f['id'] can be read
     """
     drive = _drive_gen()
-    return _list_file(folder_path, drive)[1]
+    return _in_folder(folder_path, drive, lambda folder_id: _list_folder(folder_id, drive))
 
 
-def file_replace(file_name: str, file_content: str, folder_path: List[str]) -> None:
+def file_replace(file_name: str, file_content: Union[bytes, BinaryIO], folder_path: List[str]) -> None:
     """
     upload file from local to gDrive, if a file with same "title" already exists, replace that file.
 
     :param file_name: filename recorded on drive e.g. resume.txt
-    :param file_content: string content of file needs to be uploaded
+    :param file_content: binary content or readable, seekable binary file object to be uploaded
     :param folder_path: a list of strings representing the path
                         from root (exclusive) to the target folder (inclusive) on the drive
-    :return: fid of uploaded file
     """
     drive = _drive_gen()
 
-    folder_id, files = _list_file(folder_path, drive)
+    def replace(folder_id: str) -> None:
+        for file in _list_folder(folder_id, drive):
+            if file['title'] == file_name:
+                file.Trash()
+        _upload(file_name, file_content, drive, folder_id)
 
-    for file in files:
-        if file['title'] == file_name:
-            file.Trash()
+    _in_folder(folder_path, drive, replace)
 
-    _upload(file_name, file_content, drive, folder_id)
 
+def file_upload(file_name: str, file_content: Union[bytes, BinaryIO], folder_path: List[str]) -> None:
+    """
+    upload file from local to gDrive
 
-def file_upload(file_name: str, file_content: str, folder_path: List[str]) -> None:
+    :param file_name: filename recorded on drive e.g. resume.txt
+    :param file_content: binary content or readable, seekable binary file object to be uploaded
+    :param folder_path: a list of strings representing the path
+                        from root (exclusive) to the target folder (inclusive) on the drive
+    """
     drive = _drive_gen()
+    _in_folder(folder_path, drive, lambda folder_id: _upload(file_name, file_content, drive, folder_id))
 
-    folder_id = _create_or_find_folder(folder_path, drive)
-    _upload(file_name, file_content, drive, folder_id)
+
+def file_upload_resumable(file_name: str, file_content: BinaryIO, folder_path: List[str],
+                          checkpoint: Checkpoint, **kwargs) -> dict:
+    """
+    upload file from local to gDrive through a resumable upload session. if checkpoint holds an
+    unfinished session, the upload continues from the last chunk the drive acknowledged.
+
+    :param file_name: filename recorded on drive e.g. resume.txt
+    :param file_content: readable, seekable binary file object to be uploaded
+    :param folder_path: a list of strings representing the path
+                        from root (exclusive) to the target folder (inclusive) on the drive
+    :param checkpoint: local record of the upload progress
+    :param kwargs: passed on to ResumableUpload, e.g. chunksize
+    :return: metadata of uploaded file, e.g. its fid as ['id'], ['fileSize'] and ['md5Checksum']
+    :raise IOError: if the upload failed, e.g. on errors of the drive or the connection
+    """
+    drive = _drive_gen()
+
+    upload = ResumableUpload(DriveSession.get().http(), checkpoint, **kwargs)
+    try:
+        return _in_folder(folder_path, drive, lambda folder_id: upload.run(file_name, folder_id, file_content))
+    except (ApiRequestError, httplib2.HttpLib2Error) as e:
+        # e.g. resolving the folder failed
+        raise IOError(f"could not upload {file_name} to /{'/'.join(folder_path)}: {e}") from e
 
 
-def file_download(file_name: str, folder_path: List[str], target_path: str):
+def file_download(file_name: str, folder_path: List[str], target_path: str, file_id: str = None):
     """
 
     :param file_name: name of the file to be downloaded
     :param folder_path: a list of strings representing the path from root (exclusive)
                         to a gDrive folder containingsource file (inclusive) on the drive
     :param target_path: local path to a file to which the file be downloaded
-    :return: content of downloaded file as string
+    :param file_id: fid of the file if known, which skips looking it up by name
+    :return: content of downloaded file as bytes
     """
     drive = _drive_gen()
 
-    fid = None
-    for file in _list_file(folder_path, drive)[1]:
-        if file['title'] == file_name:
-            fid = file['id']
-            break
+    file = drive.CreateFile({'id': file_id or _file_id(file_name, folder_path, drive)})
+    file.FetchContent()
+    return file.content.getvalue()
 
-    if not fid:
-        raise FileNotFoundError(f"file {file_name} is not found under /{'/'.join(folder_path)}")
 
-    file = drive.CreateFile({'id': fid})
-    return file.GetContentString()
+def file_stream(file_name: str, folder_path: List[str], chunksize: int = CHUNK_SIZE,
+                file_id: str = None, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """
+    download a file in chunks without holding its whole content in memory
+
+    :param file_name: name of the file to be downloaded
+    :param folder_path: a list of strings representing the path from root (exclusive)
+                        to a gDrive folder containing source file (inclusive) on the drive
+    :param chunksize: number of bytes requested from the drive at a time
+    :param file_id: fid of the file if known, which skips looking it up by name
+    :param start: offset of the first byte to download
+    :param end: offset just past the last byte to download, or None for the end of the file
+    :return: iterator over the content of the file as bytes chunks
+    """
+    drive = _drive_gen()
+
+    file_id = file_id or _file_id(file_name, folder_path, drive)
+    if start or end is not None:
+        return _streamed(_ranged_stream(file_id, file_name, folder_path, chunksize, start, end),
+                         file_name, folder_path)
+    file = drive.CreateFile({'id': file_id})
+    try:
+        return _streamed(file.GetContentIOBuffer(chunksize=chunksize), file_name, folder_path)
+    except ApiRequestError as e:
+        if _is_not_found(e):
+            raise FileNotFoundError(f"file {file_name} is not found under /{'/'.join(folder_path)}")
+        raise
+
+
+def file_stat(file_name: str, folder_path: List[str], file_id: str = None) -> dict:
+    """
+    :param file_name: name of the file
+    :param folder_path: a list of strings representing the path from root (exclusive)
+                        to a gDrive folder containing the file (inclusive) on the drive
+    :param file_id: fid of the file if known, which skips looking it up by name
+    :return: metadata of the file, e.g. its fid as ['id'], ['fileSize'] and ['md5Checksum']
+    """
+    drive = _drive_gen()
+
+    file = drive.CreateFile({'id': file_id or _file_id(file_name, folder_path, drive)})
+    try:
+        file.FetchMetadata(fields='id,title,fileSize,md5Checksum')
+    except ApiRequestError as e:
+        if _is_not_found(e):
+            raise FileNotFoundError(f"file {file_name} is not found under /{'/'.join(folder_path)}")
+        raise
+    return dict(file)
 
 
 def create_folder(folder_path: List[str]) -> str:
@@ -84,35 +169,104 @@ def create_folder(folder_path: List[str]) -> str:
     drive = _drive_gen()
     return _create_or_find_folder(folder_path, drive)
 
-def file_delete(file_name:str, folder_path: List[str]):
+def file_delete(file_name:str, folder_path: List[str], file_id: str = None):
     """
     delete a file if it exists, raise exception if file not found
     :param file_name: name of the file to be deleted
     :param folder_path: a list of strings representing the path from root (exclusive)
                         to a gDrive folder containingsource file (inclusive) on the drive
+    :param file_id: fid of the file if known, which skips looking it up by name
     """   
     drive = _drive_gen()
-    deleted = False
-    folder_id, files = _list_file(folder_path, drive)
-    for file in files:
-        if file['title'] == file_name:
-            file.Trash()
-            deleted = True
-    if not deleted:
-        raise FileNotFoundError(f"file {file_name} is not found under /{'/'.join(folder_path)}")
+
+    file = drive.CreateFile({'id': file_id or _file_id(file_name, folder_path, drive)})
+    try:
+        file.Trash()
+    except ApiRequestError as e:
+        if _is_not_found(e):
+            raise FileNotFoundError(f"file {file_name} is not found under /{'/'.join(folder_path)}")
+        raise
 
 
 
 # util?
 
-def _list_file(folder_path: List[str], drive: GoogleDrive) -> Tuple[str, list]:
-    folder_id = _create_or_find_folder(folder_path, drive)
-    return folder_id, drive.ListFile({
+def _list_folder(folder_id: str, drive: GoogleDrive) -> list:
+    return drive.ListFile({
         'q': f"'{folder_id}' in parents and trashed=false"
     }).GetList()
 
 
+def _file_id(file_name: str, folder_path: List[str], drive: GoogleDrive) -> str:
+    """
+    look a file up by name with a server-side query, for callers that do not know its fid
+    """
+    def find(folder_id: str) -> str:
+        files = drive.ListFile({
+            'q': f"title='{file_name}' and '{folder_id}' in parents and trashed=false"
+        }).GetList()
+        if not files:
+            raise FileNotFoundError(f"file {file_name} is not found under /{'/'.join(folder_path)}")
+        return files[0]['id']
+
+    return _in_folder(folder_path, drive, find)
+
+
+def _in_folder(folder_path: List[str], drive: GoogleDrive, operation: Callable[[str], T]) -> T:
+    """
+    run operation with the fid of the folder. if that fid came from the folder cache and the drive
+    reports it as gone, the cache entry is dropped and operation retried once with a fresh fid. a
+    404 is only blamed on the folder once the drive confirmed that the folder itself is missing, and
+    files missing from a folder that exists leave the cache alone.
+    """
+    cached = _folders.get(folder_path) is not None
+    folder_id = _create_or_find_folder(folder_path, drive)
+    try:
+        return operation(folder_id)
+    except (ApiRequestError, ResumableUploadError) as e:
+        if not cached or not _is_not_found(e) or _folder_exists(folder_id, drive):
+            raise
+    _folders.invalidate(folder_path)
+    return operation(_create_or_find_folder(folder_path, drive))
+
+
+def _is_not_found(error: Exception) -> bool:
+    """
+    :return: whether the drive answered a request with 404
+    """
+    if isinstance(error, ApiRequestError):
+        return error.error.get('code') == 404
+    if isinstance(error, ResumableUploadError):
+        return error.status == 404
+    return False
+
+
+def _folder_exists(folder_id: str, drive: GoogleDrive) -> bool:
+    folder = drive.CreateFile({'id': folder_id})
+    try:
+        folder.FetchMetadata(fields='id,labels')
+    except ApiRequestError as e:
+        if _is_not_found(e):
+            return False
+        raise
+    return not folder.get('labels', {}).get('trashed', False)
+
+
 def _create_or_find_folder(folder_path: List[str], drive: GoogleDrive) -> str:
+    folder_id = _folders.get(folder_path)
+    if folder_id:
+        return folder_id
+
+    # Only one thread resolves (and possibly creates) a given folder, the others wait for its result
+    with _folders.lock(folder_path), stats.phase('folder_resolve'):
+        folder_id = _folders.get(folder_path)
+        if not folder_id:
+            folder_id = _resolve_folder(folder_path, drive)
+            _folders.put(folder_path, folder_id)
+        return folder_id
+
+
+def _resolve_folder(folder_path: List[str], drive: GoogleDrive) -> str:
     parent = 'root'
     for name in folder_path:
         folders = drive.ListFile({
@@ -129,13 +283,59 @@ def _create_or_find_folder(folder_path: List[str], drive: GoogleDrive) -> str:
     return parent
 
 
+def _ranged_stream(file_id: str, file_name: str, folder_path: List[str], chunksize: int,
+                   start: int, end: Optional[int]) -> Iterator[bytes]:
+    """
+    download the bytes from start to end of a file with one range request per chunk
+    """
+    http = DriveSession.get().http()
+    while end is None or start < end:
+        last = start + chunksize if end is None else min(start + chunksize, end)
+        resp, content = http.request(MEDIA_URL.format(file_id), 'GET',
+                                     headers={'Range': f"bytes={start}-{last - 1}"})
+        if resp.status == 404:
+            raise FileNotFoundError(f"file {file_name} is not found under /{'/'.join(folder_path)}")
+        if resp.status == 416:  # start is past the end of the file
+            return
+        if resp.status == 200:  # the range was ignored and the whole file sent
+            yield content[start:end]
+            return
+        if resp.status != 206:
+            raise IOError(f"could not download {file_name}: {resp.status} {content!r}")
+        if content:
+            yield content
+        if len(content) < last - start:  # reached the end of the file
+            return
+        start = last
+
+
+def _streamed(chunks, file_name: str, folder_path: List[str]) -> Iterator[bytes]:
+    """
+    yield the chunks of a download, raising the errors of the drive or the connection
+    in the middle of it as IOError, like the local provider does
+    """
+    try:
+        yield from chunks
+    except (ApiRequestError, httplib2.HttpLib2Error) as e:
+        raise IOError(f"could not download {file_name} from /{'/'.join(folder_path)}: {e}") from e
+
+
 def _drive_gen() -> GoogleDrive:
-    return GoogleDrive(drive_login())
+    return DriveSession.get().drive
 
 
-def _upload(file_name: str, file_content: str, drive: GoogleDrive, parent_id: str) -> None:
+def _upload(file_name: str, file_content: Union[bytes, BinaryIO], drive: GoogleDrive, parent_id: str) -> None:
+    # Content always travels as raw bytes, so ciphertext never has to be
+    # base64 encoded to pass through SetContentString
+    if isinstance(file_content, str):
+        file_content = file_content.encode()
+    if isinstance(file_content, (bytes, bytearray)):
+        file_content = io.BytesIO(file_content)
     file = drive.CreateFile()
-    file.SetContentString(file_content)
+    # pydrive2 uploads file objects in resumable chunks, so the content
+    # never has to be held in memory as a whole
+    file.content = file_content
+    file['mimeType'] = 'application/octet-stream'
     file['title'] = file_name
     file['parents'] = [{'id': parent_id}]
     file.Upload()
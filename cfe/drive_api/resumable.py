@@ -0,0 +1,184 @@
+import io
+import json
+import re
+from typing import BinaryIO, Callable, Optional
+
+import httplib2
+
+from .. import stats
+from ..checkpoint import CHECKPOINT_DIR, Checkpoint
+
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v2/files?uploadType=resumable"
+CHUNK_SIZE = 32 * 256 * 1024  # chunks must be a multiple of 256 KiB
+RETRIES = 3
+RESUME_INCOMPLETE = 308
+
+
+class ResumableUploadError(IOError):
+    """
+    upload that could not complete. an IOError like the transport errors of the other
+    providers, so that callers handle all of them alike
+    """
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class ResumableUpload:
+    """
+    uploads a file object through the drive's resumable upload protocol, checkpointing the
+    acknowledged offset so that an interrupted upload continues where it stopped. a session
+    that expired is replaced by a new one once, which uploads the file from the start
+    """
+
+    def __init__(self, http: httplib2.Http, checkpoint: Checkpoint, upload_url: str = UPLOAD_URL,
+                 chunksize: int = CHUNK_SIZE, segment_size: Optional[int] = None, header_size: int = 0,
+                 progress: Optional[Callable[[int], None]] = None):
+        """
+        :param http: authorized http object used for all requests
+        :param checkpoint: where the progress of this upload is recorded
+        :param upload_url: endpoint that creates upload sessions
+        :param chunksize: bytes sent per request, a multiple of 256 KiB
+        :param segment_size: size of one ciphertext segment including its tag, used to record
+                             the segment index in the checkpoint
+        :param header_size: length of the ciphertext header preceding the first segment
+        :param progress: called with the number of bytes the server holds whenever that changes
+        """
+        self.http = http
+        self.checkpoint = checkpoint
+        self.upload_url = upload_url
+        self.chunksize = chunksize
+        self.segment_size = segment_size
+        self.header_size = header_size
+        self.progress = progress
+
+    def run(self, title: str, parent_id: str, stream: BinaryIO) -> dict:
+        """
+        :param title: filename recorded on drive
+        :param parent_id: fid of the folder the file is uploaded to
+        :param stream: readable, seekable binary file object with the content
+        :return: metadata of the uploaded file
+        """
+        total = stream.seek(0, io.SEEK_END)
+
+        offset = None
+        if self.checkpoint.get('session'):
+            offset = self._query(total)
+            if isinstance(offset, dict):
+                self.checkpoint.remove()
+                return offset
+        if offset is None:
+            self._start(title, parent_id, total)
+            offset = 0
+        self._report(offset)
+
+        failures = 0
+        restarted = False
+        while True:
+            stream.seek(offset)
+            data = stream.read(self.chunksize)
+            headers = {'Content-Length': str(len(data))}
+            if data:
+                headers['Content-Range'] = f"bytes {offset}-{offset + len(data) - 1}/{total}"
+            else:
+                headers['Content-Range'] = f"bytes */{total}"
+
+            try:
+                with stats.phase('network', len(data)):
+                    resp, content = self.http.request(self.checkpoint.get('session'), 'PUT', body=data,
+                                                      headers=headers)
+            except (httplib2.HttpLib2Error, OSError):
+                resp, content = None, b''
+
+            if resp is not None and resp.status in (200, 201):
+                self.checkpoint.remove()
+                self._report(total)
+                return json.loads(content)
+            if resp is not None and resp.status == RESUME_INCOMPLETE:
+                offset = _acknowledged(resp)
+                self._commit(offset)
+                failures = 0
+                continue
+            if resp is not None and resp.status == 404:
+                # The session expired, the upload has to start over in a new one
+                if restarted:
+                    raise ResumableUploadError("upload session expired", resp.status)
+                restarted = True
+                self._start(title, parent_id, total)
+                offset = 0
+                continue
+            if resp is not None and resp.status < 500:
+                raise ResumableUploadError(f"upload failed with status {resp.status}: {content!r}", resp.status)
+
+            # Connection dropped or the server failed; ask it how much it got and retry from there
+            failures += 1
+            if failures > RETRIES:
+                raise ResumableUploadError(f"upload interrupted at byte {offset} of {total}")
+            acknowledged = self._query(total)
+            if isinstance(acknowledged, dict):
+                self.checkpoint.remove()
+                return acknowledged
+            if acknowledged is None:
+                if restarted:
+                    raise ResumableUploadError("upload session expired")
+                restarted = True
+                self._start(title, parent_id, total)
+                acknowledged = 0
+            offset = acknowledged
+            self._commit(offset)
+
+    def _start(self, title: str, parent_id: str, total: int) -> None:
+        body = json.dumps({'title': title, 'parents': [{'id': parent_id}]})
+        headers = {
+            'Content-Type': 'application/json; charset=UTF-8',
+            'X-Upload-Content-Type': 'application/octet-stream',
+            'X-Upload-Content-Length': str(total),
+        }
+        try:
+            with stats.phase('network'):
+                resp, content = self.http.request(self.upload_url, 'POST', body=body, headers=headers)
+        except (httplib2.HttpLib2Error, OSError) as e:
+            raise ResumableUploadError(f"could not start upload session: {e}")
+        if resp.status != 200 or 'location' not in resp:
+            raise ResumableUploadError(f"could not start upload session: {resp.status} {content!r}", resp.status)
+        self.checkpoint.update(session=resp['location'], total=total)
+        self._commit(0)
+
+    def _query(self, total: int):
+        """
+        :return: number of bytes the server holds, the file metadata if the upload already
+                 completed, or None if the session no longer exists
+        """
+        headers = {'Content-Length': '0', 'Content-Range': f"bytes */{total}"}
+        try:
+            with stats.phase('network'):
+                resp, content = self.http.request(self.checkpoint.get('session'), 'PUT', body=b'', headers=headers)
+        except (httplib2.HttpLib2Error, OSError) as e:
+            raise ResumableUploadError(f"could not query upload session: {e}")
+        if resp.status in (200, 201):
+            return json.loads(content)
+        if resp.status == RESUME_INCOMPLETE:
+            return _acknowledged(resp)
+        if 400 <= resp.status < 500:
+            return None
+        raise ResumableUploadError(f"could not query upload session: {resp.status} {content!r}")
+
+    def _commit(self, offset: int) -> None:
+        segment = None
+        if self.segment_size:
+            segment = max(0, offset - self.header_size) // self.segment_size
+        self.checkpoint.update(committed=offset, segment=segment)
+        self._report(offset)
+
+    def _report(self, offset: int) -> None:
+        if self.progress is not None:
+            self.progress(offset)
+
+
+def _acknowledged(resp) -> int:
+    """
+    :return: offset of the first byte the server has not received yet, read from the Range header
+    """
+    match = re.match(r"bytes=0-(\d+)", resp.get('range', ''))
+    return int(match.group(1)) + 1 if match else 0
@@ -0,0 +1,45 @@
+"""
+Modules that are imported when first used rather than when cfe starts.
+
+Every cfe invocation pays for the imports of cfe.__main__, including ones
+that only print help or forward their command to the agent. Binding the
+heavy ones (cryptography, tqdm, the provider clients) through lazy_import
+keeps those invocations fast while the commands that need them use them
+exactly as before.
+"""
+import importlib.util
+import sys
+
+
+def lazy_import(name, package=None):
+    """
+    Returns the module called name, resolved relative to package like
+    importlib.import_module, without executing it until one of its
+    attributes is accessed. A module that is already imported is returned
+    as is.
+    """
+    name = importlib.util.resolve_name(name, package)
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load(*modules):
+    """
+    Executes those of the modules returned by lazy_import that were not
+    used yet. LazyLoader is only thread-safe from Python 3.12.3 on: before
+    that, a thread using a module while another one executes it sees it
+    half initialised, so commands load the modules their worker threads
+    use before starting any.
+    """
+    for module in modules:
+        # Accessing any attribute executes a lazy module
+        getattr(module, '__spec__')
@@ -0,0 +1,83 @@
+"""
+Bounded producer/consumer stages for overlapping disk, CPU and network work.
+
+Chaining stages, e.g. reading segments from disk, encrypting them and
+uploading them, lets each stage work on its own item at the same time, so
+the time spent per file approaches that of the slowest stage rather than
+the sum of all of them. The bounded queues keep memory use flat.
+"""
+import queue
+import threading
+
+DEPTH = 2
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Pipeline:
+    """
+    Iterator over iterable whose items are produced on a background thread,
+    at most depth items ahead of the consumer. Exceptions raised while
+    producing are re-raised to the consumer.
+    """
+
+    def __init__(self, iterable, depth=DEPTH):
+        self._items = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._produce, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item = self._items.get()
+        if item is _DONE:
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self._finished = True
+            raise item.error
+        return item
+
+    def close(self):
+        """
+        Stops the producer and waits for its thread to exit. Stages feeding
+        this one have to be closed after it, since its thread may be blocked
+        waiting for them.
+        """
+        self._finished = True
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+            self._put(_DONE)
+        except BaseException as e:
+            self._put(_Failure(e))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
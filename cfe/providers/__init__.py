@@ -0,0 +1,98 @@
+"""
+Storage providers the encrypted files can be kept in.
+
+The provider in use is chosen with 'cfe add provider <name>' and recorded
+next to the vault. Providers are only imported once selected, so the local
+and in-memory ones work without the Drive dependencies or credentials. The
+in-memory one loses its files when the process exits, so it is never
+recorded; benchmarks and tests install it with use().
+"""
+import json
+import os
+import threading
+
+from .base import Backend, RemoteFile
+
+CONFIG_PATH = os.path.join('vault', 'provider.json')
+DEFAULT = 'drive'
+
+
+def _drive(**options):
+    from .drive import DriveBackend
+    return DriveBackend(**options)
+
+
+def _local(**options):
+    from .local import LocalBackend
+    return LocalBackend(**options)
+
+
+def _memory(**options):
+    from .memory import MemoryBackend
+    return MemoryBackend(**options)
+
+
+PROVIDERS = {
+    'drive': _drive,
+    'local': _local,
+    'memory': _memory,
+}
+# Providers whose files only live as long as the process
+EPHEMERAL = {'memory'}
+
+_lock = threading.Lock()
+_backend = None
+
+
+def create(name, **options):
+    """
+    Returns a new backend of the provider called name, configured with options
+    """
+    if name not in PROVIDERS:
+        raise ValueError(f"unknown provider {name}, expected one of {', '.join(PROVIDERS)}")
+    return PROVIDERS[name](**options)
+
+
+def select(name, **options):
+    """
+    Sets the provider called name up, makes it the one used from now on and returns its backend
+    """
+    global _backend
+    if name in EPHEMERAL:
+        raise ValueError(f"the {name} provider loses its files when the process exits and cannot be selected")
+    backend = create(name, **options)
+    backend.setup()
+    with open(CONFIG_PATH, 'w') as f:
+        json.dump({'name': name, 'options': options}, f)
+    with _lock:
+        _backend = backend
+    return backend
+
+
+def get():
+    """
+    Returns the backend of the selected provider, the same one for the whole process
+    """
+    global _backend
+    with _lock:
+        if _backend is None:
+            try:
+                with open(CONFIG_PATH) as f:
+                    config = json.load(f)
+            except (OSError, ValueError):
+                # Vaults from before providers could be chosen keep their files on the drive
+                config = {'name': DEFAULT}
+            if config['name'] in EPHEMERAL:
+                raise ValueError(f"the {config['name']} provider recorded in {CONFIG_PATH} loses its files when "
+                                 f"the process exits, select another one with 'cfe add provider'")
+            _backend = create(config['name'], **config.get('options', {}))
+        return _backend
+
+
+def use(backend):
+    """
+    Makes backend the one returned by get() for the rest of the process, without recording it
+    """
+    global _backend
+    with _lock:
+        _backend = backend
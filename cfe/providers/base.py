@@ -0,0 +1,67 @@
+from typing import BinaryIO, Callable, Iterator, List, NamedTuple, Optional
+
+from ..checkpoint import Checkpoint
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class RemoteFile(NamedTuple):
+    """
+    what a provider knows about a stored file
+    """
+    id: str
+    name: str
+    size: Optional[int] = None
+    checksum: Optional[str] = None
+
+
+class Backend:
+    """
+    storage provider the encrypted files are kept in. every provider keeps its files in a single flat
+    namespace; files are addressed by name, or by the id the provider returned on upload when the
+    caller has it, which may save a lookup. operations on a file that does not exist raise
+    FileNotFoundError.
+    """
+
+    name = None
+    # Bytes the provider sends per request, which uploads prepare ahead of time
+    upload_chunk_size = CHUNK_SIZE
+
+    def setup(self) -> None:
+        """
+        prepare the provider for use, e.g. log in and create the folder files are kept in
+        """
+
+    def upload(self, file_name: str, stream: BinaryIO, checkpoint: Optional[Checkpoint] = None,
+               progress: Optional[Callable[[int], None]] = None, **kwargs) -> RemoteFile:
+        """
+        :param file_name: name the file is stored under
+        :param stream: readable, seekable binary file object with the content
+        :param checkpoint: local record of the upload progress, from which an interrupted upload
+                           continues if the provider supports it
+        :param progress: called with the number of bytes stored so far whenever that changes
+        :param kwargs: provider specific upload options, ignored by providers that have no use for them
+        :return: the stored file
+        """
+        raise NotImplementedError
+
+    def download(self, file_name: str, file_id: Optional[str] = None, start: int = 0,
+                 end: Optional[int] = None, chunksize: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        :param file_name: name of the file
+        :param file_id: id of the file if known
+        :param start: offset of the first byte to download
+        :param end: offset just past the last byte to download, or None for the end of the file
+        :param chunksize: size of the chunks the content is returned in
+        :return: iterator over the content of the file as bytes chunks
+        """
+        raise NotImplementedError
+
+    def delete(self, file_name: str, file_id: Optional[str] = None) -> None:
+        raise NotImplementedError
+
+    def list(self) -> List[RemoteFile]:
+        raise NotImplementedError
+
+    def stat(self, file_name: str, file_id: Optional[str] = None) -> RemoteFile:
+        raise NotImplementedError
@@ -0,0 +1,50 @@
+from typing import BinaryIO, Callable, Iterator, List, Optional
+
+from .. import stats
+from ..drive_api import auth, func, resumable
+from ..checkpoint import Checkpoint
+from .base import CHUNK_SIZE, Backend, RemoteFile
+
+FOLDER = ['.cfe']
+
+
+class DriveBackend(Backend):
+    """
+    files kept in the .cfe folder of a Google Drive, uploaded through resumable upload sessions
+    """
+
+    name = 'drive'
+    upload_chunk_size = resumable.CHUNK_SIZE
+
+    def __init__(self, folder_path: List[str] = FOLDER):
+        self.folder_path = folder_path
+
+    def setup(self) -> None:
+        auth.DriveSession.get()
+        func.create_folder(self.folder_path)
+
+    def upload(self, file_name: str, stream: BinaryIO, checkpoint: Optional[Checkpoint] = None,
+               progress: Optional[Callable[[int], None]] = None, **kwargs) -> RemoteFile:
+        metadata = func.file_upload_resumable(file_name, stream, self.folder_path, checkpoint or Checkpoint(),
+                                              progress=progress, **kwargs)
+        return _remote_file(metadata)
+
+    def download(self, file_name: str, file_id: Optional[str] = None, start: int = 0,
+                 end: Optional[int] = None, chunksize: int = CHUNK_SIZE) -> Iterator[bytes]:
+        chunks = func.file_stream(file_name, self.folder_path, chunksize, file_id=file_id, start=start, end=end)
+        return stats.timed('network', chunks)
+
+    def delete(self, file_name: str, file_id: Optional[str] = None) -> None:
+        func.file_delete(file_name, self.folder_path, file_id=file_id)
+
+    def list(self) -> List[RemoteFile]:
+        return [_remote_file(file) for file in func.file_list(self.folder_path)]
+
+    def stat(self, file_name: str, file_id: Optional[str] = None) -> RemoteFile:
+        return _remote_file(func.file_stat(file_name, self.folder_path, file_id=file_id))
+
+
+def _remote_file(metadata) -> RemoteFile:
+    size = metadata.get('fileSize')
+    return RemoteFile(metadata['id'], metadata.get('title'), int(size) if size is not None else None,
+                      metadata.get('md5Checksum'))
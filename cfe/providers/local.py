@@ -0,0 +1,99 @@
+import hashlib
+import os
+import time
+from typing import BinaryIO, Callable, Iterator, List, Optional
+
+from .. import stats
+from ..checkpoint import Checkpoint
+from .base import CHUNK_SIZE, Backend, RemoteFile
+
+ROOT = os.path.join('vault', 'files')
+PARTIAL = '.part'
+
+
+class LocalBackend(Backend):
+    """
+    files kept in a local directory, e.g. a mounted disk or a synced folder. the id of a file is its
+    name. uploads are written next to their destination and renamed into place once complete, and
+    continue from the bytes already written if interrupted.
+    """
+
+    name = 'local'
+
+    def __init__(self, root: str = ROOT):
+        self.root = root
+
+    def setup(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+
+    def upload(self, file_name: str, stream: BinaryIO, checkpoint: Optional[Checkpoint] = None,
+               progress: Optional[Callable[[int], None]] = None, chunksize: int = CHUNK_SIZE,
+               **kwargs) -> RemoteFile:
+        checkpoint = checkpoint or Checkpoint()
+        path = self._path(file_name)
+        partial = path + PARTIAL
+        os.makedirs(self.root, exist_ok=True)
+
+        # Only bytes that made it to disk before the checkpoint was written are kept
+        offset = checkpoint.get('committed', 0) if os.path.exists(partial) else 0
+        digest = hashlib.md5()
+        with open(partial, 'r+b' if offset else 'w+b') as f:
+            f.truncate(offset)
+            for block in iter(lambda: f.read(chunksize), b""):
+                digest.update(block)
+            stream.seek(offset)
+            for chunk in iter(lambda: stream.read(chunksize), b""):
+                start = time.perf_counter()
+                f.write(chunk)
+                digest.update(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+                stats.add('network', time.perf_counter() - start, len(chunk))
+                offset += len(chunk)
+                checkpoint.update(committed=offset)
+                if progress is not None:
+                    progress(offset)
+        os.replace(partial, path)
+        checkpoint.remove()
+        return RemoteFile(file_name, file_name, offset, digest.hexdigest())
+
+    def download(self, file_name: str, file_id: Optional[str] = None, start: int = 0,
+                 end: Optional[int] = None, chunksize: int = CHUNK_SIZE) -> Iterator[bytes]:
+        # Opened before returning, so that a missing file is reported right away
+        f = open(self._path(file_id or file_name), 'rb')
+        return stats.timed('network', _read_range(f, start, end, chunksize))
+
+    def delete(self, file_name: str, file_id: Optional[str] = None) -> None:
+        os.remove(self._path(file_id or file_name))
+
+    def list(self) -> List[RemoteFile]:
+        if not os.path.isdir(self.root):
+            return []
+        return [RemoteFile(entry.name, entry.name, entry.stat().st_size)
+                for entry in os.scandir(self.root) if entry.is_file() and not entry.name.endswith(PARTIAL)]
+
+    def stat(self, file_name: str, file_id: Optional[str] = None) -> RemoteFile:
+        name = file_id or file_name
+        with open(self._path(name), 'rb') as f:
+            digest = hashlib.md5()
+            for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(block)
+            return RemoteFile(name, name, f.tell(), digest.hexdigest())
+
+    def _path(self, file_name: str) -> str:
+        if not file_name or os.path.basename(file_name) != file_name or file_name in ('.', '..'):
+            raise ValueError(f"invalid file name {file_name!r}")
+        return os.path.join(self.root, file_name)
+
+
+def _read_range(f: BinaryIO, start: int, end: Optional[int], chunksize: int) -> Iterator[bytes]:
+    with f:
+        f.seek(start)
+        remaining = None if end is None else max(0, end - start)
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunksize if remaining is None else min(chunksize, remaining))
+            if not chunk:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,58 @@
+import hashlib
+import threading
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional
+
+from .. import stats
+from ..checkpoint import Checkpoint
+from .base import CHUNK_SIZE, Backend, RemoteFile
+
+
+class MemoryBackend(Backend):
+    """
+    files kept in memory for the lifetime of the process, for benchmarks and tests that should not
+    touch a disk or a network. the id of a file is its name.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: Dict[str, bytes] = {}
+
+    def upload(self, file_name: str, stream: BinaryIO, checkpoint: Optional[Checkpoint] = None,
+               progress: Optional[Callable[[int], None]] = None, **kwargs) -> RemoteFile:
+        stream.seek(0)
+        content = stream.read()
+        with self._lock:
+            self._files[file_name] = content
+        if checkpoint is not None:
+            checkpoint.remove()
+        if progress is not None:
+            progress(len(content))
+        return RemoteFile(file_name, file_name, len(content), hashlib.md5(content).hexdigest())
+
+    def download(self, file_name: str, file_id: Optional[str] = None, start: int = 0,
+                 end: Optional[int] = None, chunksize: int = CHUNK_SIZE) -> Iterator[bytes]:
+        content = memoryview(self._get(file_id or file_name))[start:end]
+        return stats.timed('network', (bytes(content[i:i + chunksize]) for i in range(0, len(content), chunksize)))
+
+    def delete(self, file_name: str, file_id: Optional[str] = None) -> None:
+        name = file_id or file_name
+        with self._lock:
+            if self._files.pop(name, None) is None:
+                raise FileNotFoundError(f"file {name} is not found")
+
+    def list(self) -> List[RemoteFile]:
+        with self._lock:
+            return [RemoteFile(name, name, len(content)) for name, content in self._files.items()]
+
+    def stat(self, file_name: str, file_id: Optional[str] = None) -> RemoteFile:
+        name = file_id or file_name
+        content = self._get(name)
+        return RemoteFile(name, name, len(content), hashlib.md5(content).hexdigest())
+
+    def _get(self, name: str) -> bytes:
+        with self._lock:
+            if name not in self._files:
+                raise FileNotFoundError(f"file {name} is not found")
+            return self._files[name]
@@ -0,0 +1,118 @@
+"""
+Per-phase timings of a command, reported with 'cfe --stats' or CFE_STATS=1.
+
+Every phase accumulates the time spent in it, the bytes it processed and how
+often it ran, across all threads. Stages of a pipeline run at the same time,
+so their times add up to more than the wall clock time of the command; the
+phase with the most time is the bottleneck. Phases may also nest: kdf is
+part of vault_load, for instance.
+
+Phases: kdf, vault_load, vault_save, folder_resolve, content_mac, chunk
+(splitting chunked files), compress, disk_read, encrypt, network (transfers
+to or from the provider), decrypt, decompress and disk_write.
+
+Recording is off unless enabled, in which case the calls cost next to
+nothing.
+"""
+import contextlib
+import json
+import sys
+import threading
+import time
+
+_lock = threading.Lock()
+_enabled = False
+_start = None
+# phase name: [seconds, bytes, calls]
+_phases = {}
+
+
+def enable():
+    """
+    Starts recording, discarding whatever was recorded before
+    """
+    global _enabled, _start
+    with _lock:
+        _phases.clear()
+        _enabled = True
+        _start = time.perf_counter()
+
+
+def enabled():
+    return _enabled
+
+
+def add(name, seconds, size=0):
+    """
+    Records that seconds were spent in the phase called name, processing size bytes
+    """
+    if not _enabled:
+        return
+    with _lock:
+        phase = _phases.setdefault(name, [0.0, 0, 0])
+        phase[0] += seconds
+        phase[1] += size
+        phase[2] += 1
+
+
+@contextlib.contextmanager
+def phase(name, size=0):
+    """
+    Records the time spent in the with block as the phase called name
+    """
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start, size)
+
+
+def timed(name, iterable):
+    """
+    Returns an iterator over iterable that records the time spent producing
+    every item, and its length, as the phase called name
+    """
+    if not _enabled:
+        return iter(iterable)
+    return _timed(name, iter(iterable))
+
+
+def report():
+    """
+    Returns the recorded phases with their throughput, and the time since recording was enabled
+    """
+    with _lock:
+        phases = {}
+        for name, (seconds, size, calls) in sorted(_phases.items()):
+            phases[name] = {
+                'seconds': seconds,
+                'bytes': size,
+                'calls': calls,
+                'mb_per_s': size / (1024 * 1024) / seconds if size and seconds else None,
+            }
+    wall = time.perf_counter() - _start if _start is not None else 0.0
+    return {'wall_seconds': wall, 'phases': phases}
+
+
+def emit(stream=None):
+    """
+    Writes the report as a line of JSON to stream, stderr by default
+    """
+    stream = stream or sys.stderr
+    stream.write(json.dumps(report()) + "\n")
+    stream.flush()
+
+
+def _timed(name, iterator):
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            add(name, time.perf_counter() - start)
+            return
+        add(name, time.perf_counter() - start, len(item))
+        yield item
@@ -1,94 +1,634 @@
-import os
-import base64
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-
-
-def generate_random_key():
-    """
-    Returns a new random cryptographic key
-    """
-    return Fernet.generate_key()
-
-def generate_password_key(password, salt):
-    """
-    Returns a password-based cryptographic key generated by scrypt
-    when given a password string
-    """
-    password_bytes = str.encode(password)
-
-    # Scrypt is a key derivation function (KDF) that generates a
-    # cryptographic key. It's main benefit is that is bottlenecked
-    # by a machine's memory access speed. This means that it would
-    # be difficult for an adversary to brute force attack scrypt
-
-    kdf = Scrypt(
-        salt=salt,  # Random salt to prevent brute-force
-        length=32,  # Output length of bytes
-        n=2**14,    # Computational cost, reccomended value in https://www.tarsnap.com/scrypt/scrypt.pdf
-        r=8,        # Block size
-        p=1,        # Parallelization parameter
-    )
-
-    key = base64.urlsafe_b64encode(kdf.derive(password_bytes))
-    return key
-
-
-def encrypt(key, message):
-    """
-    Returns an AES-CBC encryption of the message under the key
-    """
-
-    # Fernet uses AES in CBC mode with a 128-bit key for encryption
-    # and decryption. It uses the standard PKCS7 padding
-
-    f = Fernet(key)
-    ciphertext = None
-    if type(message) == bytes:
-        ciphertext = f.encrypt(message)
-    else:
-        message_bytes = str.encode(message)
-        ciphertext = f.encrypt(message_bytes)
-    return ciphertext
-
-
-def decrypt(key, ciphertext):
-    """
-    Returns an AES-CBC decryption of the ciphertext under the key
-    """
-
-    if type(ciphertext) is str:
-        ciphertext = str.encode(ciphertext)
-
-    # Fernet uses AES in CBC mode with a 128-bit key for encryption
-    # and decryption. It uses the standard PKCS7 padding
-
-    f = Fernet(key)
-    message = f.decrypt(ciphertext)
-    return message
-
-
-if __name__ == "__main__":
-    # (1) Encrypt a file (random cryptographic key)
-    file_key = generate_random_key()
-    enc_file = encrypt(file_key, "contents of the file")
-    print("Encrypted File:", enc_file)
-
-    # (2) Encrypt a row entry (password-based key)
-    salt = os.urandom(16)
-    pb_key = generate_password_key("password123", salt)
-    enc_entry = encrypt(pb_key, "entry: " + file_key.decode())
-    print("Encrypted Entry:", enc_entry)
-    print()
-
-    # (3) Decrypt a row entry (password-based key)
-    pb_key = generate_password_key("password123", salt) # Note that salt can be stored in plaintext
-    dec_entry = decrypt(pb_key, enc_entry)
-    print("Decrypted Entry:", dec_entry)
-
-    # (4) Decrypt a file (random cryptographic key)
-    file_key = dec_entry[7:] # get rid of text
-    dec_file = decrypt(file_key, enc_file)
-    print("Decrypted File:", dec_file)
+import concurrent.futures
+import io
+import os
+import base64
+import struct
+import time
+from typing import NamedTuple
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from .. import compression as compress
+from .. import stats
+from ..pipeline import Pipeline
+
+# Streaming ciphertext format:
+#
+#   header  = magic (4) | version (1) | segment size (4) | salt (16)
+#   segment = AES-256-GCM(plaintext segment) | tag (16)
+#
+# Every segment but the last holds exactly `segment size` bytes of plaintext.
+# The nonce of a segment is its index followed by a flag that is only set on
+# the final segment, and the header is authenticated with every segment, so
+# reordered, dropped or truncated segments all fail to decrypt.
+#
+# Version 2 headers add the compression method of the plaintext after the
+# version. Streams that are not compressed keep the version 1 header.
+STREAM_MAGIC = b"CFES"
+STREAM_VERSION = 1
+STREAM_VERSION_COMPRESSED = 2
+SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+SALT_SIZE = 16
+_HEADER = struct.Struct(">4sBI16s")
+_HEADER_COMPRESSED = struct.Struct(">4sBBI16s")
+HEADER_SIZE = _HEADER.size
+_PREFIX_SIZE = len(STREAM_MAGIC) + 1
+
+# Password keys are derived by scrypt, the only KDF so far. KDF_SCRYPT is
+# what vault headers record as the algorithm.
+KDF_SCRYPT = 1
+# Bounds on what calibrate_kdf picks
+KDF_MAX_LANES = 16
+KDF_MAX_MEMORY = 1024 * 1024 * 1024
+
+
+class KdfParams(NamedTuple):
+    """
+    Cost parameters of scrypt: n is the CPU and memory cost, a power of
+    two, r the block size and p the number of lanes derived in parallel
+    """
+    n: int = 2**14
+    r: int = 8
+    p: int = 1
+
+    def memory(self):
+        """
+        Returns the bytes of memory the lanes need together
+        """
+        return 128 * self.r * self.n * self.p
+
+
+DEFAULT_KDF = KdfParams()
+
+
+def generate_random_key():
+    """
+    Returns a new random cryptographic key
+    """
+    return Fernet.generate_key()
+
+def generate_password_key(password, salt, kdf=DEFAULT_KDF):
+    """
+    Returns a password-based cryptographic key generated by scrypt
+    when given a password string, with the cost parameters in kdf
+    """
+    password_bytes = str.encode(password)
+
+    # Scrypt is a key derivation function (KDF) that generates a
+    # cryptographic key. It's main benefit is that is bottlenecked
+    # by a machine's memory access speed. This means that it would
+    # be difficult for an adversary to brute force attack scrypt.
+    #
+    # OpenSSL computes the p blocks of scrypt one after the other, so
+    # p > 1 is done here instead as p independent scrypt derivations of
+    # the password with the salt and the lane index, which run on separate
+    # cores, and whose outputs are combined by HKDF. A single lane is plain
+    # scrypt, which keeps the keys of vaults that predate the parameters.
+
+    with stats.phase("kdf"):
+        if kdf.p == 1:
+            key = _scrypt(password_bytes, salt, kdf.n, kdf.r)
+        else:
+            lanes = _scrypt_lanes(password_bytes, salt, kdf)
+            key = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b"cfe kdf lanes").derive(b"".join(lanes))
+    return base64.urlsafe_b64encode(key)
+
+
+def calibrate_kdf(target_ms, cores=None):
+    """
+    Returns the KDF parameters whose derivation takes about target_ms
+    milliseconds on this host, and never less than the defaults. Every core
+    gets a lane of its own, and n is doubled for as long as the derivation
+    stays within the target and the lanes within KDF_MAX_MEMORY.
+    """
+    cores = cores or os.cpu_count() or 1
+    kdf = KdfParams(DEFAULT_KDF.n, DEFAULT_KDF.r, min(cores, KDF_MAX_LANES))
+    salt = os.urandom(SALT_SIZE)
+
+    def seconds(params):
+        start = time.perf_counter()
+        generate_password_key("calibration", salt, params)
+        return time.perf_counter() - start
+
+    # A derivation takes time proportional to n, but less so once a lane
+    # no longer fits the caches, so the estimate is checked on the result
+    elapsed = seconds(kdf)
+    n = kdf.n
+    while elapsed * 2 * 1000 <= target_ms and kdf.memory() * 2 <= KDF_MAX_MEMORY:
+        n *= 2
+        elapsed *= 2
+        kdf = kdf._replace(n=n)
+    while kdf.n > DEFAULT_KDF.n and seconds(kdf) * 1000 > target_ms * 1.25:
+        kdf = kdf._replace(n=kdf.n // 2)
+    return kdf
+
+
+def _scrypt(password, salt, n, r):
+    return Scrypt(
+        salt=salt,  # Random salt to prevent brute-force
+        length=32,  # Output length of bytes
+        n=n,        # Computational cost, at least the value reccomended in https://www.tarsnap.com/scrypt/scrypt.pdf
+        r=r,        # Block size
+        p=1,        # Parallelization parameter
+    ).derive(password)
+
+
+def _scrypt_lanes(password, salt, kdf):
+    salts = [salt + struct.pack(">I", lane) for lane in range(kdf.p)]
+    workers = min(kdf.p, os.cpu_count() or 1)
+    if workers == 1:
+        return [_scrypt(password, lane_salt, kdf.n, kdf.r) for lane_salt in salts]
+    # OpenSSL holds the GIL while deriving, so the lanes need processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return [*pool.map(_scrypt, [password] * kdf.p, salts, [kdf.n] * kdf.p, [kdf.r] * kdf.p)]
+
+
+def derive_subkey(key, salt, info=b"cfe subkey"):
+    """
+    Returns a cryptographic key derived from another key by HKDF. Unlike
+    generate_password_key this is cheap, so a single password key can
+    protect many entries that each get their own subkey.
+    """
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=info,
+    )
+    return base64.urlsafe_b64encode(hkdf.derive(base64.urlsafe_b64decode(key)))
+
+
+def key_check(key, size=8):
+    """
+    Returns a short tag that identifies the key. The tag is an HMAC under
+    the key itself, so it reveals nothing about the key or the password it
+    was derived from, but lets records locked by other keys be told apart
+    without attempting to decrypt them.
+    """
+    h = hmac.HMAC(base64.urlsafe_b64decode(key), hashes.SHA256())
+    h.update(b"cfe key check")
+    return h.finalize()[:size]
+
+
+def content_mac(key, src, block_size=1024 * 1024):
+    """
+    Returns the hex HMAC-SHA256 of everything read from the binary file
+    object src. Under a secret key, equal macs identify equal contents
+    without revealing anything about them to whoever sees the mac.
+    """
+    start, size = time.perf_counter(), 0
+    h = hmac.HMAC(base64.urlsafe_b64decode(key), hashes.SHA256())
+    for block in iter(lambda: src.read(block_size), b""):
+        h.update(block)
+        size += len(block)
+    stats.add("content_mac", time.perf_counter() - start, size)
+    return h.finalize().hex()
+
+
+def encrypt(key, message):
+    """
+    Returns an AES-CBC encryption of the message under the key
+    """
+
+    # Fernet uses AES in CBC mode with a 128-bit key for encryption
+    # and decryption. It uses the standard PKCS7 padding
+
+    f = Fernet(key)
+    ciphertext = None
+    if type(message) == bytes:
+        ciphertext = f.encrypt(message)
+    else:
+        message_bytes = str.encode(message)
+        ciphertext = f.encrypt(message_bytes)
+    return ciphertext
+
+
+def decrypt(key, ciphertext):
+    """
+    Returns an AES-CBC decryption of the ciphertext under the key
+    """
+
+    if type(ciphertext) is str:
+        ciphertext = str.encode(ciphertext)
+
+    if is_stream(ciphertext):
+        return b"".join(iter_decrypt(key, io.BytesIO(ciphertext)))
+
+    # Fernet uses AES in CBC mode with a 128-bit key for encryption
+    # and decryption. It uses the standard PKCS7 padding
+
+    f = Fernet(key)
+    message = f.decrypt(ciphertext)
+    return message
+
+
+def is_stream(ciphertext):
+    """
+    Returns whether the ciphertext starts with a streaming format header
+    """
+    if type(ciphertext) is str:
+        ciphertext = str.encode(ciphertext)
+    return ciphertext[:len(STREAM_MAGIC)] == STREAM_MAGIC
+
+
+def encrypted_size(size, segment_size=SEGMENT_SIZE, compression=compress.NONE):
+    """
+    Returns the length of the ciphertext stream of a size byte plaintext,
+    after compression if any
+    """
+    segments = max(1, -(-size // segment_size))
+    return header_size(compression) + size + segments * TAG_SIZE
+
+
+def header_size(compression=compress.NONE):
+    """
+    Returns the length of the header of a stream compressed with compression
+    """
+    return _HEADER.size if compression == compress.NONE else _HEADER_COMPRESSED.size
+
+
+def _stream_header_size(prefix):
+    """
+    Returns the length of the header starting with the magic and version in prefix
+    """
+    magic, version = prefix[:len(STREAM_MAGIC)], prefix[len(STREAM_MAGIC)]
+    if magic != STREAM_MAGIC:
+        raise InvalidToken
+    if version == STREAM_VERSION:
+        return _HEADER.size
+    if version == STREAM_VERSION_COMPRESSED:
+        return _HEADER_COMPRESSED.size
+    raise InvalidToken
+
+
+class SegmentCipher:
+    """
+    Encrypts and decrypts the individual segments of one ciphertext stream
+    """
+
+    def __init__(self, key, salt=None, segment_size=SEGMENT_SIZE, compression=compress.NONE):
+        if salt is None:
+            salt = os.urandom(SALT_SIZE)
+        self.salt = salt
+        self.segment_size = segment_size
+        self.compression = compression
+        if compression == compress.NONE:
+            self.header = _HEADER.pack(STREAM_MAGIC, STREAM_VERSION, segment_size, salt)
+        else:
+            self.header = _HEADER_COMPRESSED.pack(STREAM_MAGIC, STREAM_VERSION_COMPRESSED,
+                                                  compression, segment_size, salt)
+
+        # Every stream gets its own AES key, derived from the entry key and
+        # the random salt in the header
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            info=b"cfe stream",
+        )
+        self._aead = AESGCM(hkdf.derive(base64.urlsafe_b64decode(key)))
+
+    @classmethod
+    def from_header(cls, key, header):
+        """
+        Returns the cipher for the stream starting with header
+        """
+        if len(header) < _PREFIX_SIZE or len(header) != _stream_header_size(header):
+            raise InvalidToken
+        if len(header) == _HEADER.size:
+            _, _, segment_size, salt = _HEADER.unpack(header)
+            compression = compress.NONE
+        else:
+            _, _, compression, segment_size, salt = _HEADER_COMPRESSED.unpack(header)
+            if compression not in compress.METHODS.values() or compression == compress.NONE:
+                raise InvalidToken
+        if segment_size == 0:
+            raise InvalidToken
+        return cls(key, salt, segment_size, compression)
+
+    def encrypt_segment(self, index, plaintext, last):
+        with stats.phase("encrypt", len(plaintext)):
+            return self._aead.encrypt(_segment_nonce(index, last), plaintext, self.header)
+
+    def decrypt_segment(self, index, ciphertext, last):
+        try:
+            with stats.phase("decrypt", len(ciphertext)):
+                return self._aead.decrypt(_segment_nonce(index, last), ciphertext, self.header)
+        except InvalidTag:
+            raise InvalidToken
+
+
+def iter_encrypt(key, src, segment_size=SEGMENT_SIZE):
+    """
+    Yields the ciphertext stream of the binary file object src one
+    segment at a time, starting with the header
+    """
+    cipher = SegmentCipher(key, segment_size=segment_size)
+    yield cipher.header
+
+    # Read one segment ahead so that we know which segment is the last
+    index = 0
+    segment = _read_full(src, segment_size)
+    while True:
+        following = _read_full(src, segment_size)
+        last = not following
+        yield cipher.encrypt_segment(index, segment, last)
+        if last:
+            return
+        segment = following
+        index += 1
+
+
+def iter_decrypt(key, src):
+    """
+    Yields the plaintext of the ciphertext stream in the binary file object
+    src one segment at a time, decompressing it if it was compressed. Raises
+    InvalidToken if the stream was tampered with or truncated.
+    """
+    prefix = _read_full(src, _PREFIX_SIZE)
+    if len(prefix) < _PREFIX_SIZE:
+        raise InvalidToken
+    header = prefix + _read_full(src, _stream_header_size(prefix) - _PREFIX_SIZE)
+    cipher = SegmentCipher.from_header(key, header)
+    decompressor = compress.decompressor(cipher.compression)
+    size = cipher.segment_size + TAG_SIZE
+
+    index = 0
+    segment = _read_full(src, size)
+    while True:
+        following = _read_full(src, size)
+        last = not following
+        yield decompressor.decompress(cipher.decrypt_segment(index, segment, last))
+        if last:
+            yield decompressor.flush()
+            return
+        segment = following
+        index += 1
+
+
+class StreamDecryptor:
+    """
+    Incrementally decrypts a ciphertext that arrives in arbitrarily sized
+    chunks, decompressing it if it was compressed. At most one segment plus
+    one chunk is buffered at a time.
+
+    Objects uploaded before the streaming format are single Fernet tokens,
+    which can only be authenticated as a whole; those are buffered and
+    decrypted in finalize().
+    """
+
+    def __init__(self, key):
+        self._key = key
+        self._cipher = None
+        self._decompressor = None
+        self._legacy = False
+        self._buffer = bytearray()
+        self._index = 0
+
+    def update(self, data):
+        """
+        Feeds the next chunk of ciphertext and returns the plaintext of every
+        segment that is now complete
+        """
+        self._buffer += data
+        if self._legacy:
+            return b""
+
+        if self._cipher is None:
+            if len(self._buffer) < len(STREAM_MAGIC):
+                return b""
+            if not is_stream(bytes(self._buffer[:len(STREAM_MAGIC)])):
+                self._legacy = True
+                return b""
+            if len(self._buffer) < _PREFIX_SIZE:
+                return b""
+            size = _stream_header_size(bytes(self._buffer[:_PREFIX_SIZE]))
+            if len(self._buffer) < size:
+                return b""
+            self._cipher = SegmentCipher.from_header(self._key, bytes(self._buffer[:size]))
+            self._decompressor = compress.decompressor(self._cipher.compression)
+            del self._buffer[:size]
+
+        # A full segment is only decrypted once more data follows it, since
+        # the last segment cannot be recognised until the stream ends
+        size = self._cipher.segment_size + TAG_SIZE
+        segments = []
+        while len(self._buffer) > size:
+            segments.append((self._index, bytes(self._buffer[:size]), False))
+            del self._buffer[:size]
+            self._index += 1
+        plaintext = b"".join(self._cipher.decrypt_segment(*segment) for segment in segments)
+        if self._cipher.compression == compress.NONE:
+            return plaintext
+        with stats.phase("decompress", len(plaintext)):
+            return self._decompressor.decompress(plaintext)
+
+    def finalize(self):
+        """
+        Returns the remaining plaintext once the whole ciphertext was fed.
+        Raises InvalidToken if the ciphertext was tampered with or truncated.
+        """
+        if self._legacy or self._cipher is None:
+            # Objects uploaded as text hold the base64 Fernet token, possibly
+            # with surrounding whitespace
+            return decrypt(self._key, bytes(self._buffer).strip())
+        plaintext = self._cipher.decrypt_segment(self._index, bytes(self._buffer), True)
+        self._buffer = bytearray()
+        if self._cipher.compression == compress.NONE:
+            return plaintext
+        with stats.phase("decompress", len(plaintext)):
+            return self._decompressor.decompress(plaintext) + self._decompressor.flush()
+
+
+def encrypt_stream(key, src, dst, segment_size=SEGMENT_SIZE):
+    """
+    Encrypts the binary file object src into the binary file object dst
+    """
+    for chunk in iter_encrypt(key, src, segment_size):
+        dst.write(chunk)
+
+
+def decrypt_stream(key, src, dst):
+    """
+    Decrypts the ciphertext stream in src into the binary file object dst
+    """
+    for chunk in iter_decrypt(key, src):
+        dst.write(chunk)
+
+
+class EncryptingReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over the ciphertext stream of a plaintext
+    file. Segments are encrypted on demand, so only one segment is held in
+    memory regardless of the size of the file. Since segment encryption is
+    deterministic for a given salt, seeking back re-reads identical bytes.
+
+    With a depth, segments are read from disk and encrypted on two background
+    threads, each up to depth segments ahead of sequential reads, so that
+    reading, encryption and whatever consumes the stream overlap.
+
+    src is encrypted as it is; if it holds compressed plaintext, compression
+    names the method so that it is recorded in the header.
+    """
+
+    def __init__(self, key, src, size, salt=None, segment_size=SEGMENT_SIZE, depth=0, compression=compress.NONE):
+        super().__init__()
+        self._cipher = SegmentCipher(key, salt, segment_size, compression)
+        self._src = src
+        self._plain_size = size
+        self._size = encrypted_size(size, segment_size, compression)
+        self._segments = max(1, -(-size // segment_size))
+        self._pos = 0
+        self._cached = (None, b"")
+        self._depth = depth
+        # Index of the next segment the pipeline yields and its stages
+        self._next = None
+        self._stages = []
+
+    @property
+    def salt(self):
+        return self._cipher.salt
+
+    @property
+    def header_size(self):
+        return len(self._cipher.header)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._pos
+        out = []
+        while size > 0 and self._pos < self._size:
+            chunk = self._chunk_at(self._pos)[:size]
+            out.append(chunk)
+            self._pos += len(chunk)
+            size -= len(chunk)
+        return b"".join(out)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _chunk_at(self, pos):
+        """
+        Returns the ciphertext from pos to the end of the header or segment
+        containing it
+        """
+        header = self._cipher.header
+        if pos < len(header):
+            return header[pos:]
+
+        segment_size = self._cipher.segment_size
+        index, offset = divmod(pos - len(header), segment_size + TAG_SIZE)
+        if self._cached[0] != index:
+            if self._depth:
+                self._cached = (index, self._pipelined_segment(index))
+            else:
+                start = time.perf_counter()
+                self._src.seek(index * segment_size)
+                plaintext = _read_full(self._src, segment_size)
+                stats.add("disk_read", time.perf_counter() - start, len(plaintext))
+                last = index == self._segments - 1
+                self._cached = (index, self._cipher.encrypt_segment(index, plaintext, last))
+        return self._cached[1][offset:]
+
+    def close(self):
+        self._stop_pipeline()
+        super().close()
+
+    def _pipelined_segment(self, index):
+        """
+        Returns the encrypted segment from the pipeline, restarting it at
+        index if the stream was not read sequentially
+        """
+        if self._next != index:
+            self._stop_pipeline()
+            reads = Pipeline(self._read_segments(index), self._depth)
+            segments = ((i, plaintext, i == self._segments - 1) for i, plaintext in reads)
+            encrypted = Pipeline((self._cipher.encrypt_segment(*segment) for segment in segments), self._depth)
+            self._stages = [encrypted, reads]
+        self._next = index + 1
+        return next(self._stages[0])
+
+    def _read_segments(self, index):
+        segment_size = self._cipher.segment_size
+        self._src.seek(index * segment_size)
+        for i in range(index, self._segments):
+            start = time.perf_counter()
+            plaintext = _read_full(self._src, segment_size)
+            stats.add("disk_read", time.perf_counter() - start, len(plaintext))
+            yield i, plaintext
+
+    def _stop_pipeline(self):
+        # Downstream stages first, as they may be waiting on upstream ones
+        for stage in self._stages:
+            stage.close()
+        self._stages = []
+        self._next = None
+
+
+def _segment_nonce(index, last):
+    return index.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+
+def _read_full(src, size):
+    """
+    Reads exactly size bytes from src unless the end of the file is reached
+    """
+    chunks = []
+    while size > 0:
+        chunk = src.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+if __name__ == "__main__":
+    # (1) Encrypt a file (random cryptographic key)
+    file_key = generate_random_key()
+    enc_file = encrypt(file_key, "contents of the file")
+    print("Encrypted File:", enc_file)
+
+    # (2) Encrypt a row entry (password-based key)
+    salt = os.urandom(16)
+    pb_key = generate_password_key("password123", salt)
+    enc_entry = encrypt(pb_key, "entry: " + file_key.decode())
+    print("Encrypted Entry:", enc_entry)
+    print()
+
+    # (3) Decrypt a row entry (password-based key)
+    pb_key = generate_password_key("password123", salt) # Note that salt can be stored in plaintext
+    dec_entry = decrypt(pb_key, enc_entry)
+    print("Decrypted Entry:", dec_entry)
+
+    # (4) Decrypt a file (random cryptographic key)
+    file_key = dec_entry[7:] # get rid of text
+    dec_file = decrypt(file_key, enc_file)
+    print("Decrypted File:", dec_file)
@@ -1,180 +1,822 @@
 from .crypto import *
+from .. import stats
 import os, sys
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import hashlib
+import itertools
+import json
 import logging
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: writers are not serialised
+    fcntl = None
+
+VAULT_PATH = "vault/cfe_vault.dat"
+
+# Vault file layout (version 3):
+#
+#   header = magic (4) | version (1) | salt (16) | kdf (1) | log2 n (1) | r (2) | p (2)
+#   record = type (1) | length (4) | body
+#
+# The file is an append-only journal: creating an entry appends its record
+# and deleting one appends a tombstone with the id (nonce) of the deleted
+# record, each fsynced on its own. Once enough records are dead, the live
+# ones are compacted into a fresh snapshot that atomically replaces the file.
+# Writers hold a lock on a file next to the vault, and first catch up with
+# whatever other processes wrote since they last read the vault, so that
+# every record is appended at the real end of the file.
+#
+# The password key is derived once per vault from the salt in the header,
+# by the KDF and with the cost parameters the header records. Version 2
+# headers end after the salt and stand for the default scrypt parameters;
+# the next snapshot rewrites them as version 3. Every entry record body is the key check tag of the password key,
+# a random nonce and the entry encrypted under a cheap HKDF subkey of the
+# password key and that nonce. The tag lets records of other passwords be
+# skipped without any cryptographic work. Untagged entry records and records
+# from vaults that predate the header are kept as they are until their owner
+# opens the vault, which migrates them.
+#
+# A secret record holds the dedup secret of a password that was rekeyed,
+# sealed like an entry. Content macs were computed under the secret the
+# password key derived before, which the new key cannot derive again.
+VAULT_MAGIC = b"CFEV"
+VAULT_VERSION = 3
+NONCE_SIZE = 16
+CHECK_SIZE = 8
+_HEADER_V2 = struct.Struct(">4sB16s")
+_HEADER = struct.Struct(">4sB16sBBHH")
+_RECORD = struct.Struct(">BI")
+RECORD_UNTAGGED = 1
+RECORD_LEGACY = 2
+RECORD_ENTRY = 3
+RECORD_DELETE = 4
+RECORD_SECRET = 5
+COMPACT_MIN = 64
 
 # Data structure for an entry in the vault
 class VaultEntry:
-    def __init__(self, entryname="", key=None):
-        self.name = entryname
+    def __init__(self, nickname="", guid="", key=None):
+        self.nickname = nickname
+        self.guid = guid
+        # Drive file id, size and md5 checksum of the uploaded ciphertext,
+        # known once the upload completed
+        self.file_id = None
+        self.size = None
+        self.checksum = None
+        # Keyed mac of the plaintext, recorded by uploads in dedup mode
+        self.content_mac = None
+        # Whether the remote file is the manifest of a chunked file
+        self.chunked = False
         if key is None:
             key = generate_random_key()
         self.entry_key = key
         self.salt = os.urandom(16)
+        # Sealed record body as stored in the vault file
+        self.record = None
 
     def get_key(self):
         return self.entry_key
 
+    ''' Returns the nickname and remote GUID joined by a space, as stored by legacy vaults '''
     def get_name(self):
-        return self.name
+        return f"{self.nickname} {self.guid}"
+
+    def get_id(self):
+        return _record_id(self.record)
+
+    ''' Returns a new entry under nickname that refers to the remote file of this entry '''
+    def link(self, nickname):
+        entry = VaultEntry(nickname, self.guid, self.entry_key)
+        entry.file_id = self.file_id
+        entry.size = self.size
+        entry.checksum = self.checksum
+        entry.content_mac = self.content_mac
+        entry.chunked = self.chunked
+        return entry
 
     def encrypt_entry(self, password):
         key = self.entry_key.decode()
-        entry = f"cfe_check,{self.name},{key}"
+        entry = f"cfe_check,{self.get_name()},{key}"
         key = generate_password_key(password, self.salt)
         ciphertext = encrypt(key, entry)
         return self.salt + ciphertext
     
+    ''' Returns the entry record, encrypted under a subkey of the vault password key '''
+    def seal(self, vault_key, check):
+        nonce = os.urandom(NONCE_SIZE)
+        entry = json.dumps({
+            "nickname": self.nickname,
+            "guid": self.guid,
+            "key": self.entry_key.decode(),
+            "file_id": self.file_id,
+            "size": self.size,
+            "checksum": self.checksum,
+            "content": self.content_mac,
+            "chunked": self.chunked,
+        })
+        self.record = check + nonce + encrypt(derive_subkey(vault_key, nonce, b"cfe vault entry"), entry)
+        return self.record
+
     ''' Returns true if successfully decrypted and stored, and false otherwise '''
-    def decrypt_and_store_entry(self, password, entry_ciphertext):
-        salt, ciphertext = entry_ciphertext[:16], entry_ciphertext[16:]
-        key = generate_password_key(password, salt)
+    def unseal(self, vault_key, record):
+        nonce, ciphertext = record[:NONCE_SIZE], record[NONCE_SIZE:]
         try:
-            entry_data = decrypt(key, ciphertext).decode()
-
-            # Check if decryption is successful
-            if entry_data.startswith("cfe_check"):
-                _, self.name, self.entry_key = entry_data.split(",")
-                self.entry_key = str.encode(self.entry_key)
-                self.salt = salt
-                return True
-            else:
-                return False
-        except:
+            entry = json.loads(decrypt(derive_subkey(vault_key, nonce, b"cfe vault entry"), ciphertext))
+        except Exception:
             return False
+        if "name" in entry:
+            self._set_name(entry["name"])
+        else:
+            self.nickname, self.guid = entry["nickname"], entry["guid"]
+        self.entry_key = str.encode(entry["key"])
+        self.file_id = entry.get("file_id")
+        self.size = entry.get("size")
+        self.checksum = entry.get("checksum")
+        self.content_mac = entry.get("content")
+        self.chunked = entry.get("chunked", False)
+        return True
+
+    ''' Returns true if successfully decrypted and stored, and false otherwise '''
+    def decrypt_and_store_entry(self, password, entry_ciphertext):
+        return self._store_legacy(entry_ciphertext, _decrypt_legacy(password, entry_ciphertext))
+
+    ''' Stores the name and key of a legacy record as opened by _decrypt_legacy, if it could be '''
+    def _store_legacy(self, entry_ciphertext, opened):
+        if opened is None:
+            return False
+        name, key = opened
+        self._set_name(name)
+        self.entry_key = str.encode(key)
+        self.salt = entry_ciphertext[:16]
+        return True
+
+    ''' Splits a space-joined "nickname guid" name of older vault formats '''
+    def _set_name(self, name):
+        nickname, _, guid = name.rpartition(" ")
+        if not nickname:
+            nickname, guid = guid, ""
+        self.nickname, self.guid = nickname, guid
 
     
 # Primary Vault Class 
 class Vault:
     def __init__(self, password):
-        # Dictionary with hash of password: entries
-        self.entries = []
-        self.other_entries = []
         self.password =  password
+        self.key = None
+        self.check = None
+        # Salt and KDF parameters the key was derived with
+        self._key_source = None
+        # How deeply this object holds the journal lock
+        self._lock_depth = 0
+        self._reset()
         self._on_init()
 
+    def _reset(self):
+        # Dictionary with nickname: entry
+        self.entries = {}
+        # Sorted nicknames, for prefix and range queries
+        self.nicknames = []
+        # (record type, record body) of entries locked by other passwords
+        self.other_entries = []
+        # Dedup index: content mac: an uploaded entry with that content,
+        # and remote guid: number of entries referring to it
+        self.contents = {}
+        self.references = collections.Counter()
+        # Dedup secret kept in a secret record, if the password was rekeyed,
+        # and that record as stored in the vault file
+        self._dedup_secret = None
+        self._secret_record = None
+        self.salt = None
+        self.kdf = DEFAULT_KDF
+        # Journal bookkeeping: end of the last complete record, number of
+        # dead records, whether the file already has a header and the state
+        # of the file as this object last read or wrote it
+        self._end = 0
+        self._garbage = 0
+        self._snapshot = False
+        self._stamp = None
+
     ''' 
     Gets a list of all data entries accessible by a 
-    user passed password in the vault
+    user passed password in the vault, sorted by nickname
     
     Inputs:
+    prefix - if given, only entries whose nickname starts with prefix
+    start - if given, only entries whose nickname is at least start
+    end - if given, only entries whose nickname is below end
 
     Returns:
-    a list of all data entries accessible by password
+    a list of all matching data entries accessible by password
     '''
-    def get_data_list(self):
-        return self.entries
+    def get_data_list(self, prefix="", start=None, end=None):
+        lo = bisect.bisect_left(self.nicknames, max(prefix, start or ""))
+        hi = len(self.nicknames) if end is None else bisect.bisect_left(self.nicknames, end)
+        result = []
+        for nickname in itertools.islice(self.nicknames, lo, hi):
+            if not nickname.startswith(prefix):
+                break
+            result.append(self.entries[nickname])
+        return result
     
     ''' 
-    Gets data for a particular entry with the name 
-    entry_name 
+    Gets data for a particular entry with the nickname 
     
     Inputs:
-    entry_name - a string that represents the name of 
+    nickname - a string that represents the nickname of 
     entry being queried
 
     Returns: 
-    data entry with entry_name name and accessible by password. 
-    If data entry with entry_name name does not exist in vault, returns 
+    data entry with that nickname and accessible by password. 
+    If data entry with that nickname does not exist in vault, returns 
     None.
     '''
-    def get_data(self, entry_name_prefix):
-        for entry in self.entries:
-            if entry.get_name().startswith(entry_name_prefix):
-                return entry    
-        return None
+    def get_data(self, nickname):
+        return self.entries.get(nickname)
+
+    '''
+    Gets an uploaded entry whose file has the given content
+
+    Inputs:
+    mac - the content mac of the file, as returned by get_content_mac
+
+    Returns:
+    a data entry whose remote file holds that content, or None if no
+    entry accessible by password was uploaded with it in dedup mode
+    '''
+    def find_content(self, mac):
+        return self.contents.get(mac)
+
+    '''
+    Computes the dedup index key of a file
+
+    Inputs:
+    src - a binary file object with the content
+
+    Returns:
+    the mac of the content under a secret derived from the vault password,
+    so equal files of the same password get equal macs
+    '''
+    def get_content_mac(self, src):
+        return content_mac(self._dedup_key(), src)
+
+    '''
+    Creates a new data entry with the nickname, referring to the remote file of another entry
+
+    Inputs:
+    nickname - a string that represents the nickname of the entry being created
+    target - the VaultEntry whose remote file is shared
+
+    Returns:
+    new VaultEntry if vault successfully creates a new entry with that password lock
+    old VaultEntry if entry with that nickname already exists under password
+    '''
+    def link_data(self, nickname, target):
+        with self._journal():
+            if nickname in self.entries:
+                return self.entries[nickname]
+            new_entry = target.link(nickname)
+            self._add(new_entry)
+            self._on_append([(RECORD_ENTRY, new_entry.seal(self.key, self.check))])
+            return new_entry
+
+    '''
+    Counts the entries sharing the remote file of an entry
+
+    Inputs:
+    entry - a VaultEntry of this vault
+
+    Returns:
+    the number of entries, including entry itself, whose remote file is the one of entry
+    '''
+    def get_references(self, entry):
+        return self.references[entry.guid]
+
+    '''
+    Reloads the vault if another process changed it since this object last
+    read or wrote it. The password key is reused while the salt stays the same.
+
+    Returns:
+    True if the vault was reloaded, False if it was up to date
+    '''
+    def refresh(self):
+        if _file_stamp() == self._stamp:
+            return False
+        self._reset()
+        self._on_init()
+        return True
 
     '''
-    Creates a new data entry with the name entry_name 
+    Derives the password key anew, with a fresh salt and the given KDF
+    parameters, and reseals all entries under it
 
     Inputs:
-    password - a string that represents a user password
-    entry_name - a string that represents the name of the 
+    kdf - the KdfParams the key is derived with from now on
+
+    Returns:
+    True if the vault was rekeyed, False if it also holds entries of other
+    passwords that are sealed under keys derived with the current salt and
+    parameters, which would become unreadable
+    '''
+    def rekey(self, kdf):
+        with self._journal():
+            if any(record_type in (RECORD_ENTRY, RECORD_UNTAGGED, RECORD_SECRET)
+                   for record_type, _ in self.other_entries):
+                return False
+            # The content macs of the entries stay valid under the secret they were computed with
+            self._dedup_secret = self._dedup_key()
+            self._secret_record = None
+            self.salt = os.urandom(16)
+            self.kdf = kdf
+            self._derive_key()
+            for entry in self.entries.values():
+                entry.record = None
+            self._on_save()
+            return True
+
+    '''
+    Creates a new data entry with the nickname, stored remotely as guid
+
+    Inputs:
+    nickname - a string that represents the nickname of the 
     entry being created
+    guid - a string that represents the name of the remote file
 
     Returns:
     new VaultEntry if vault successfully creates a new entry with that password lock
-    old VaultEntry if entry with name entry_name already exists under password
+    old VaultEntry if entry with that nickname already exists under password
     None if error occurs in creation or cannot authenticate query
     '''
-    def create_data(self, entry_name):
-        for entry in self.entries:
-            if entry.get_name() == entry_name:
-                return entry
-        new_entry = VaultEntry(entry_name)
-        self.entries.append(new_entry)
-        self._on_save()
-        return new_entry
+    def create_data(self, nickname, guid):
+        with self._journal():
+            if nickname in self.entries:
+                return self.entries[nickname]
+            new_entry = VaultEntry(nickname, guid)
+            self._add(new_entry)
+            self._on_append([(RECORD_ENTRY, new_entry.seal(self.key, self.check))])
+            return new_entry
+
+    '''
+    Adds new data entries to the vault in a single journal write
+
+    Inputs:
+    entries - VaultEntry objects whose nicknames are not in the vault yet
+
+    Returns:
+    the entries that were added, leaving out those whose nickname already exists
+    '''
+    def add_data(self, entries):
+        with self._journal():
+            added = [entry for entry in entries if entry.nickname not in self.entries]
+            for entry in added:
+                self._add(entry)
+            if added:
+                self._on_append([(RECORD_ENTRY, entry.seal(self.key, self.check)) for entry in added])
+            return added
+
+    '''
+    Saves changes made to the fields of an entry of this vault
+
+    Inputs:
+    entry - the VaultEntry that was changed
+    '''
+    def update_data(self, entry):
+        with self._journal():
+            # The content of the entry may have changed with its remote file
+            for mac, indexed in [*self.contents.items()]:
+                if indexed is entry and mac != entry.content_mac:
+                    self._unindex(entry, mac)
+            # Another process may have replaced the entry in the meantime,
+            # the last update wins
+            current = self.entries.get(entry.nickname)
+            stale = [entry] if current is None or current is entry else [entry, current]
+            records = [(RECORD_DELETE, old.get_id()) for old in stale if old.record is not None]
+            self._garbage += 2 * len(records)
+            if current is not None and current is not entry:
+                self._remove(entry.nickname)
+            records.append((RECORD_ENTRY, entry.seal(self.key, self.check)))
+            self._add(entry)
+            self._on_append(records)
 
     
     '''
-    Deletes a data entry in the vault with name entry_name
+    Deletes a data entry in the vault with the nickname
 
     Inputs:
-    entry_name - a string that represents the name of the entry to be deleted
+    nickname - a string that represents the nickname of the entry to be deleted
 
     Returns:
-    True if an entry with entry_name under that password is succesfully deleted.
+    True if an entry with that nickname under that password is succesfully deleted.
     False otherwise.
     '''
-    def delete_data(self, entry_name_prefix):
-        i = 0
-        for entry in self.entries:
-            if entry.get_name().startswith(entry_name_prefix):
-                self.entries.pop(i)
-                self._on_save()
-                return True
-            else:
-                i += 1
-        return False
+    def delete_data(self, nickname):
+        with self._journal():
+            entry = self._remove(nickname)
+            if entry is None:
+                return False
+            self._garbage += 2
+            self._on_append([(RECORD_DELETE, entry.get_id())])
+            return True
+
+    def _remove(self, nickname):
+        entry = self.entries.pop(nickname, None)
+        if entry is None:
+            return None
+        del self.nicknames[bisect.bisect_left(self.nicknames, nickname)]
+        self.references[entry.guid] -= 1
+        if self.contents.get(entry.content_mac) is entry:
+            self._unindex(entry, entry.content_mac)
+        return entry
+
+    def _add(self, entry):
+        if entry.nickname not in self.entries:
+            bisect.insort(self.nicknames, entry.nickname)
+            self.references[entry.guid] += 1
+        self.entries[entry.nickname] = entry
+        self._index(entry)
+
+    def _index(self, entry):
+        # Only content that made it to the remote can be shared
+        if entry.content_mac is not None and entry.file_id is not None:
+            self.contents.setdefault(entry.content_mac, entry)
+
+    def _unindex(self, entry, mac):
+        del self.contents[mac]
+        # Another entry may still hold the same content
+        for other in self.entries.values():
+            if other is not entry and other.content_mac == mac and other.file_id is not None:
+                self.contents[mac] = other
+                break
 
         
-    ''' Called when program exits.
+    ''' Holds the journal lock, reentrantly for this object '''
+    @contextlib.contextmanager
+    def _locked(self):
+        if self._lock_depth or fcntl is None:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+        with open(VAULT_PATH + ".lock", "ab") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+
+    ''' Holds the journal lock around a mutation, with the vault as other processes left it '''
+    @contextlib.contextmanager
+    def _journal(self):
+        with self._locked():
+            self._sync()
+            yield
+
+    ''' Catches up with the records other processes wrote since this object
+        last read or wrote the vault. Appended records are replayed; after a
+        snapshot the vault is reloaded, keeping the entries whose records did
+        not change.
+    '''
+    def _sync(self):
+        stamp = _file_stamp()
+        if stamp == self._stamp:
+            return
+        with open(VAULT_PATH, "rb") as f:
+            data = f.read()
+        appended = (self._snapshot and stamp is not None and self._stamp is not None
+                    and stamp[0] == self._stamp[0] and len(data) >= self._end)
+        if not appended:
+            known = {entry.record: entry for entry in self.entries.values() if entry.record is not None}
+            self._reset()
+            self._on_init(known)
+            return
+        records, self._end = _read_records(data, self._end)
+        self._stamp = stamp
+        ids = {entry.get_id(): entry for entry in self.entries.values() if entry.record is not None}
+        for record_type, body in records:
+            if record_type == RECORD_DELETE:
+                self._garbage += 2
+                entry = ids.pop(body, None)
+                if entry is not None and self.entries.get(entry.nickname) is entry:
+                    self._remove(entry.nickname)
+                else:
+                    self.other_entries = [(other_type, other) for other_type, other in self.other_entries
+                                          if _record_id(other) != body]
+                continue
+            entry = VaultEntry()
+            if record_type == RECORD_ENTRY and body[:CHECK_SIZE] == self.check \
+                    and entry.unseal(self.key, body[CHECK_SIZE:]):
+                entry.record = body
+                self._remove(entry.nickname)
+                self._add(entry)
+                ids[entry.get_id()] = entry
+            else:
+                self.other_entries.append((record_type, body))
+
+    ''' Called after every mutation, with the journal lock held.
+        Appends the records of the mutation to the vault journal, or
+        compacts the vault into a new snapshot once enough records are dead
+    '''
+    def _on_append(self, records):
+        live = len(self.entries) + len(self.other_entries)
+        if not self._snapshot or self._garbage >= max(COMPACT_MIN, live):
+            self._on_save()
+            return
+
+        with stats.phase("vault_save"), open(VAULT_PATH, "r+b") as f:
+            # Drop whatever a crash may have left behind after the last
+            # complete record; _sync found that record at the current end
+            f.seek(self._end)
+            for record_type, body in records:
+                f.write(_pack_record(record_type, body))
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+            self._end = f.tell()
+        self._stamp = _file_stamp()
+
+    ''' Writes a snapshot of all live records.
         Performs the following functionalities:
-            - Encrypt entries
-            - Save new password hash to entry dictionary to local file
+            - Encrypt entries that have not been sealed yet
+            - Write the snapshot next to the vault and atomically replace it
     '''
     def _on_save(self):
-        with open("vault/cfe_vault.dat", "wb+") as f:
-            for entry in self.entries:
-                entry_ct = entry.encrypt_entry(self.password)
-                f.write(entry_ct)
-                f.write(str.encode('\n'))
-            for entry_ct in self.other_entries:
-                f.write(entry_ct)
-                f.write(str.encode('\n'))
+        tmp = VAULT_PATH + ".tmp"
+        with stats.phase("vault_save"), open(tmp, "wb") as f:
+            f.write(_pack_header(self.salt, self.kdf))
+            for entry in self.entries.values():
+                if entry.record is None:
+                    entry.seal(self.key, self.check)
+                f.write(_pack_record(RECORD_ENTRY, entry.record))
+            if self._dedup_secret is not None:
+                f.write(_pack_record(RECORD_SECRET, self._seal_secret()))
+            for record_type, body in self.other_entries:
+                f.write(_pack_record(record_type, body))
+            f.flush()
+            os.fsync(f.fileno())
+            self._end = f.tell()
+        os.replace(tmp, VAULT_PATH)
+        self._stamp = _file_stamp()
+        self._garbage = 0
+        self._snapshot = True
             
         
     ''' Loaded when vault is initiatlized
         Performs the following functionalities:
             - Load password hash to entry dictionary from local file
+            - Replay the journal, dropping deleted records
             - Unhash all entries
             - Load internal data structures
     ''' 
-    def _on_init(self):
-        all_entries = []
+    def _on_init(self, known=None):
+        with stats.phase("vault_load"):
+            self._load(known or {})
+
+    ''' Loads the vault, reusing the entries in known, by their records, instead of unsealing them again '''
+    def _load(self, known):
         try:
-            with open("vault/cfe_vault.dat", "rb") as f:
-                all_entries = f.readlines()
+            self._stamp = _file_stamp()
+            with open(VAULT_PATH, "rb") as f:
+                data = f.read()
         except:
             logging.error(f"Couldn't initialize the CFE vault. Did you run 'cfe init'?")
             sys.exit()
-        
-        for entry_ct in all_entries:
+
+        if data.startswith(VAULT_MAGIC):
+            header = _unpack_header(data)
+            if header is None:
+                logging.error(f"Unsupported CFE vault version {data[len(VAULT_MAGIC)]} or key derivation function")
+                sys.exit()
+            self.salt, self.kdf, offset = header
+            records, self._end = _read_records(data, offset)
+            # Version 2 headers are rewritten by the next snapshot
+            self._snapshot = offset == _HEADER.size
+        else:
+            # Vaults written before the header are a newline separated list
+            # of per-entry records, which are migrated to the current format
+            self.salt = os.urandom(16)
+            records = [(RECORD_LEGACY, body) for body in _split_legacy(data)]
+
+        # Replay the tombstones of the journal
+        deleted = {body for record_type, body in records if record_type == RECORD_DELETE}
+        live = []
+        for record_type, body in records:
+            if record_type == RECORD_DELETE or (record_type == RECORD_ENTRY and _record_id(body) in deleted):
+                self._garbage += 1
+            else:
+                live.append((record_type, body))
+
+        # The only scrypt derivation needed for entries in the current format
+        if self.key is None or self._key_source != (self.salt, self.kdf):
+            self._derive_key()
+
+        # Every legacy record has a salt and so a scrypt derivation of its
+        # own, which are independent and done on all cores
+        legacy = _open_legacy(self.password, [body for record_type, body in live if record_type == RECORD_LEGACY])
+
+        migrated = bool(data) and not data.startswith(VAULT_MAGIC)
+        for record_type, body in live:
             potential_entry = VaultEntry()
-            if potential_entry.decrypt_and_store_entry(self.password, entry_ct):
-                self.entries.append(potential_entry)
+            if record_type == RECORD_ENTRY:
+                # Entries of other passwords are skipped on the tag alone
+                if body in known:
+                    self._add(known[body])
+                elif body[:CHECK_SIZE] == self.check and potential_entry.unseal(self.key, body[CHECK_SIZE:]):
+                    potential_entry.record = body
+                    self._add(potential_entry)
+                else:
+                    self.other_entries.append((record_type, body))
+            elif record_type == RECORD_UNTAGGED and potential_entry.unseal(self.key, body):
+                self._add(potential_entry)
+                migrated = True
+            elif record_type == RECORD_LEGACY and potential_entry._store_legacy(body, legacy.get(body)):
+                self._add(potential_entry)
+                migrated = True
+            elif record_type == RECORD_SECRET and self._unseal_secret(body):
+                pass
             else:
-                self.other_entries.append(entry_ct)
-        
+                self.other_entries.append((record_type, body))
+
+        if migrated:
+            with self._locked():
+                # Otherwise the next mutation reloads the vault and migrates it then
+                if _file_stamp() == self._stamp:
+                    self._on_save()
+
+    def _dedup_key(self):
+        if self._dedup_secret is not None:
+            return self._dedup_secret
+        return derive_subkey(self.key, self.salt, b"cfe dedup")
+
+    ''' Returns the secret record of the dedup secret, sealed under the password key '''
+    def _seal_secret(self):
+        if self._secret_record is None:
+            nonce = os.urandom(NONCE_SIZE)
+            self._secret_record = self.check + nonce + encrypt(
+                derive_subkey(self.key, nonce, b"cfe vault secret"), self._dedup_secret)
+        return self._secret_record
+
+    ''' Takes the dedup secret from a secret record, returns false if the record is not of this password '''
+    def _unseal_secret(self, body):
+        if body[:CHECK_SIZE] != self.check:
+            return False
+        nonce, ciphertext = body[CHECK_SIZE:CHECK_SIZE + NONCE_SIZE], body[CHECK_SIZE + NONCE_SIZE:]
+        try:
+            self._dedup_secret = decrypt(derive_subkey(self.key, nonce, b"cfe vault secret"), ciphertext)
+        except Exception:
+            return False
+        self._secret_record = body
+        return True
+
+    def _derive_key(self):
+        self.key = generate_password_key(self.password, self.salt, self.kdf)
+        self.check = key_check(self.key, CHECK_SIZE)
+        self._key_source = (self.salt, self.kdf)
+
+
+def create_vault(kdf=DEFAULT_KDF):
+    '''
+    Writes an empty vault whose password keys are derived with the KDF parameters kdf
+    '''
+    with open(VAULT_PATH, "wb") as f:
+        f.write(_pack_header(os.urandom(16), kdf))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _pack_header(salt, kdf):
+    return _HEADER.pack(VAULT_MAGIC, VAULT_VERSION, salt, KDF_SCRYPT, kdf.n.bit_length() - 1, kdf.r, kdf.p)
+
+
+def _unpack_header(data):
+    '''
+    Returns the salt, the KDF parameters and the size of the header at the
+    start of data, or None if its version or KDF is not supported
+    '''
+    version = data[len(VAULT_MAGIC)]
+    if version == 2:
+        _, _, salt = _HEADER_V2.unpack_from(data)
+        return salt, DEFAULT_KDF, _HEADER_V2.size
+    if version != VAULT_VERSION:
+        return None
+    _, _, salt, algorithm, log_n, r, p = _HEADER.unpack_from(data)
+    if algorithm != KDF_SCRYPT:
+        return None
+    return salt, KdfParams(2**log_n, r, p), _HEADER.size
+
+
+def _decrypt_legacy(password, entry_ciphertext):
+    '''
+    Returns the space-joined name and the key of the entry in a legacy
+    record, or None if the record is locked by another password
+    '''
+    salt, ciphertext = entry_ciphertext[:16], entry_ciphertext[16:]
+    key = generate_password_key(password, salt)
+    try:
+        entry_data = decrypt(key, ciphertext).decode()
+    except Exception:
+        return None
+    # Check if decryption is successful
+    if not entry_data.startswith("cfe_check,"):
+        return None
+    # Nicknames may contain commas, keys never do
+    name, _, entry_key = entry_data[len("cfe_check,"):].rpartition(",")
+    return name, entry_key
+
+
+def _timed_decrypt_legacy(password, entry_ciphertext):
+    # The stats of a worker process are lost, so the time goes back with the result
+    start = time.perf_counter()
+    opened = _decrypt_legacy(password, entry_ciphertext)
+    return time.perf_counter() - start, opened
+
+
+def _open_legacy(password, bodies):
+    '''
+    Returns a dict from every legacy record body that password opens to
+    what _decrypt_legacy returned for it, running the records on a pool of
+    processes, as scrypt holds the GIL, when there are several of both
+    '''
+    workers = min(len(bodies), os.cpu_count() or 1)
+    if workers <= 1:
+        results = [_decrypt_legacy(password, body) for body in bodies]
+    else:
+        results = []
+        chunksize = max(1, len(bodies) // (4 * workers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for seconds, opened in pool.map(_timed_decrypt_legacy, itertools.repeat(password), bodies,
+                                            chunksize=chunksize):
+                stats.add("kdf", seconds)
+                results.append(opened)
+    return {body: opened for body, opened in zip(bodies, results) if opened is not None}
+
+
+def _pack_record(record_type, body):
+    return _RECORD.pack(record_type, len(body)) + body
+
+
+def _split_legacy(data):
+    '''
+    Splits a legacy vault into its records. Every record is a 16 byte salt
+    followed by a newline terminated Fernet token, but the salt itself may
+    contain newlines, so records are recognised by the token prefix rather
+    than split on newlines.
+    '''
+    pos = 0
+    while pos < len(data):
+        if data[pos + 16:pos + 18] != b"gA":
+            # Blank line left behind by an earlier save
+            pos += 1
+            continue
+        end = data.find(b"\n", pos + 16)
+        if end == -1:
+            end = len(data)
+        yield data[pos:end]
+        pos = end + 1
+
+
+def _read_records(data, offset):
+    '''
+    Returns the complete records from offset onwards and the offset just
+    past the last of them. A record cut short by a crash is ignored.
+    '''
+    records = []
+    while offset + _RECORD.size <= len(data):
+        record_type, length = _RECORD.unpack_from(data, offset)
+        end = offset + _RECORD.size + length
+        if end > len(data):
+            break
+        records.append((record_type, data[offset + _RECORD.size:end]))
+        offset = end
+    return records, offset
+
+
+def _file_stamp():
+    try:
+        st = os.stat(VAULT_PATH)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _record_id(body):
+    return body[CHECK_SIZE:CHECK_SIZE + NONCE_SIZE]
+
 
-        
 if __name__ == "__main__":
     print("Toy Example")
     entry_keys = []
     entry_keys.append(generate_random_key())
     sample_vault = Vault("password123")
-    sample_vault.create_data("arkasfile.txt")
+    sample_vault.create_data("arkasfile.txt", "arkasfile-guid")
     sample_entry = sample_vault.get_data("arkasfile.txt")
     sample_vault.delete_data("arkasfile.txt")
     
\ No newline at end of file
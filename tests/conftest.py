@@ -0,0 +1,118 @@
+import http.server
+import json
+import re
+import threading
+import uuid
+
+import httplib2
+import pytest
+
+RANGE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+)")
+
+
+class FakeUploadServer(http.server.ThreadingHTTPServer):
+    """
+    local stand-in for the drive's resumable upload endpoint: POST to upload_url starts a
+    session, PUT to the session URI sends bytes or queries the offset, answered with
+    308 and a Range header until the file is complete.
+
+    faults are injected by setting drops (the next data requests store half their bytes
+    and close the connection without answering) and by calling expire.
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.sessions = {}
+        self.files = {}
+        self.requests = []
+        self.drops = 0
+        self._lock = threading.Lock()
+
+    @property
+    def upload_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/upload"
+
+    def expire(self) -> None:
+        with self._lock:
+            self.sessions.clear()
+
+    def sent_offsets(self):
+        """
+        :return: first byte of every data request, in order
+        """
+        return [start for method, start in self.requests if method == 'PUT' and start is not None]
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        metadata = json.loads(self._body())
+        session = uuid.uuid4().hex
+        with self.server._lock:
+            self.server.requests.append(('POST', None))
+            self.server.sessions[session] = {'title': metadata['title'], 'data': bytearray(),
+                                             'total': int(self.headers['X-Upload-Content-Length'])}
+        self._reply(200, location=f"http://127.0.0.1:{self.server.server_address[1]}/session/{session}")
+
+    def do_PUT(self):
+        body = self._body()
+        match = RANGE.fullmatch(self.headers.get('Content-Range', ''))
+        start = int(match.group(1)) if match and match.group(1) else None
+        with self.server._lock:
+            self.server.requests.append(('PUT', start))
+            session = self.server.sessions.get(self.path.rsplit('/', 1)[-1])
+            if session is None:
+                return self._reply(404)
+            if match is None:
+                return self._reply(400)
+            data = session['data']
+            if start is not None:
+                if start > len(data):
+                    return self._reply(400)
+                if self.server.drops:
+                    # The connection dies halfway through the request
+                    self.server.drops -= 1
+                    data[start:] = body[:len(body) // 2]
+                    self.close_connection = True
+                    return
+                data[start:] = body
+            if len(data) < session['total']:
+                headers = {'range': f"bytes=0-{len(data) - 1}"} if data else {}
+                return self._reply(308, **headers)
+            file_id = uuid.uuid4().hex
+            self.server.files[file_id] = bytes(data)
+            metadata = {'id': file_id, 'title': session['title'], 'fileSize': str(len(data))}
+        self._reply(200, json.dumps(metadata).encode())
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _reply(self, status, content=b'', **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@pytest.fixture
+def upload_server():
+    server = FakeUploadServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def http():
+    http = httplib2.Http()
+    # 308 means resume incomplete here, not a redirect; pydrive2 does the same
+    http.redirect_codes = http.redirect_codes - {308}
+    return http
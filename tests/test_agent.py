@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from cfe import agent
+
+pytestmark = pytest.mark.skipif(not agent.available(), reason="needs Unix domain sockets")
+
+SERVER = """
+import logging, sys, threading
+from cfe import agent
+
+def run(argv):
+    logging.error("main " + argv[0])
+    thread = threading.Thread(target=logging.error, args=("thread " + argv[0],))
+    thread.start()
+    thread.join()
+    return 0
+
+agent.Agent(run, path=sys.argv[1]).serve()
+"""
+
+
+def test_every_command_gets_its_log_records(tmp_path, capfd):
+    path = str(tmp_path / 'agent.sock')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen([sys.executable, '-c', SERVER, path], env=dict(os.environ, PYTHONPATH=root))
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(path):
+            assert time.monotonic() < deadline and server.poll() is None
+            time.sleep(0.05)
+        capfd.readouterr()
+
+        for name in ("first", "second"):
+            assert agent.forward([name], path) == 0
+            assert capfd.readouterr().err.splitlines() == [f"ERROR:root:main {name}", f"ERROR:root:thread {name}"]
+    finally:
+        agent.stop(path)
+        server.wait(10)
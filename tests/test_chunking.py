@@ -0,0 +1,55 @@
+import io
+import random
+
+from cfe import chunking
+
+SECRET = b"chunking secret"
+
+
+def split(data, secret=SECRET):
+    return list(chunking.Chunker(secret).split(io.BytesIO(data)))
+
+
+def content(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def test_chunks_cover_the_file_within_bounds():
+    data = content(12 * 1024 * 1024)
+
+    chunks = split(data)
+
+    assert b"".join(chunks) == data
+    assert all(chunking.MIN_SIZE < len(chunk) <= chunking.MAX_SIZE for chunk in chunks[:-1])
+    assert len(chunks) > 4
+
+
+def test_boundaries_survive_an_insertion():
+    data = content(12 * 1024 * 1024)
+    middle = len(data) // 2
+    edited = data[:middle] + b"inserted bytes" + data[middle:]
+
+    before, after = split(data), split(edited)
+
+    assert b"".join(after) == edited
+    # Only the chunk around the insertion differs, the cuts after it realign
+    changed = set(after) - set(before)
+    assert len(changed) == 1
+    assert b"inserted bytes" in changed.pop()
+    assert len(after) == len(before)
+
+
+def test_boundaries_depend_on_the_secret():
+    data = content(8 * 1024 * 1024)
+
+    assert [len(chunk) for chunk in split(data)] != [len(chunk) for chunk in split(data, b"another secret")]
+
+
+def test_chunk_names():
+    chunker = chunking.Chunker(SECRET)
+    mac = chunker.mac(b"chunk")
+
+    assert chunking.chunk_owner(chunking.chunk_name("guid-1", mac)) == "guid-1"
+    assert chunking.chunk_owner("guid-1.enc") is None
+    assert chunking.Manifest.unpack(chunking.Manifest(5, [chunking.Chunk(mac, 5, "id", 40)]).pack()).chunks == \
+        [chunking.Chunk(mac, 5, "id", 40)]
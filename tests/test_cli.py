@@ -0,0 +1,187 @@
+import io
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+from cfe import __main__ as cfe_main
+from cfe import chunking, compression, providers
+from cfe.checkpoint import Checkpoint
+from cfe.vault import crypto, storage
+
+PASSWORD = "password"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cfe_main, 'getpass', lambda prompt="": PASSWORD)
+    monkeypatch.setattr(providers, '_backend', None)
+    os.makedirs(os.path.dirname(storage.VAULT_PATH))
+    storage.create_vault(crypto.KdfParams(2**10, 8, 1))
+    providers.select('local')
+    return tmp_path
+
+
+def cfe(*args):
+    result = CliRunner().invoke(cfe_main.cli, ['--no-agent', *args], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def cfe_process(*args):
+    """
+    Runs cfe in a fresh interpreter, where no lazily imported module was used yet
+    """
+    # Without a controlling terminal, getpass reads the password from stdin
+    result = subprocess.run([sys.executable, '-m', 'cfe', '--no-agent', *args], input=f"{PASSWORD}\n" * 2,
+                            capture_output=True, text=True, start_new_session=True, timeout=60,
+                            env=dict(os.environ, PYTHONPATH=ROOT))
+    assert result.returncode == 0, result.stderr
+    assert "ERROR" not in result.stderr, result.stderr
+    return result
+
+
+def write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def remote_files():
+    return sorted(file.name for file in providers.get().list())
+
+
+def test_upload_interrupted_while_compressing_resumes(monkeypatch, caplog):
+    write('src', b"line of a log file\n" * 10000)
+
+    def fail(*args):
+        raise OSError("No space left on device")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(compression, 'compress_file', fail)
+        cfe('upload', 'src', 'dst')
+    entry = storage.Vault(PASSWORD).get_data('dst')
+    assert entry.file_id is None
+    assert Checkpoint.for_name(entry.guid).get('compression') == compression.ZLIB
+    assert "--resume" in caplog.text
+
+    cfe('upload', '--resume', 'src', 'dst')
+    cfe('download', 'dst', 'out')
+
+    assert read('out') == read('src')
+    assert not Checkpoint.for_name(entry.guid).exists()
+
+
+def test_delete_drops_entries_without_remote_file(monkeypatch):
+    write('src', os.urandom(1000))
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("connection reset")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(providers.get(), 'upload', fail)
+        cfe('upload', 'src', 'dst')
+    guid = storage.Vault(PASSWORD).get_data('dst').guid
+
+    cfe('delete', 'dst')
+
+    assert storage.Vault(PASSWORD).get_data('dst') is None
+    assert not Checkpoint.for_name(guid).exists()
+    # and the name can be uploaded to again
+    cfe('upload', 'src', 'dst')
+    assert remote_files() == [storage.Vault(PASSWORD).get_data('dst').guid + ".enc"]
+
+
+def test_upload_dir_and_restore_in_a_fresh_process():
+    os.makedirs('src/sub')
+    files = {f"src/{'sub/' if i % 2 else ''}file-{i}": os.urandom(1000 * i) for i in range(8)}
+    for path, content in files.items():
+        write(path, content)
+
+    cfe_process('upload-dir', '--jobs', '8', 'src')
+    cfe_process('restore', '--jobs', '8', 'src/', 'out')
+
+    assert len(storage.Vault(PASSWORD).get_data_list('src/')) == 8
+    for path, content in files.items():
+        assert read(os.path.join('out', path)) == content
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """
+    :return: names of the remote files uploaded, in order
+    """
+    backend = providers.get()
+    names = []
+    upload = backend.upload
+
+    def counted(file_name, *args, **kwargs):
+        names.append(file_name)
+        return upload(file_name, *args, **kwargs)
+
+    monkeypatch.setattr(backend, 'upload', counted)
+    return names
+
+
+def chunk_files(guid):
+    return [name for name in remote_files() if chunking.chunk_owner(name) == guid]
+
+
+def test_chunked_update_uploads_only_changed_chunks(uploads):
+    data = random.Random(0).randbytes(8 * 1024 * 1024)
+    write('src', data)
+    cfe('upload', '--chunked', 'src', 'dst')
+    entry = storage.Vault(PASSWORD).get_data('dst')
+    first = chunk_files(entry.guid)
+    assert len(first) > 3
+    assert sorted(uploads) == sorted(first + [entry.guid + ".enc"])
+
+    middle = len(data) // 2
+    write('src', data[:middle] + b"inserted bytes" + data[middle:])
+    uploads.clear()
+    cfe('upload', 'src', 'dst')
+
+    # One new chunk and the manifest, and the chunk it replaced is deleted
+    assert uploads[1:] == [entry.guid + ".enc"]
+    now = chunk_files(entry.guid)
+    assert set(now) - set(first) == {uploads[0]}
+    assert len(set(first) - set(now)) == 1
+
+    cfe('download', '--chunk-jobs', '3', 'dst', 'out')
+    assert read('out') == read('src')
+
+
+def test_gc_and_delete_remove_only_unreferenced_chunks():
+    write('src', random.Random(1).randbytes(3 * 1024 * 1024))
+    cfe('upload', '--chunked', '--dedup', 'src', 'first')
+    cfe('upload', '--chunked', '--dedup', 'src', 'second')
+    entry = storage.Vault(PASSWORD).get_data('first')
+    chunks = chunk_files(entry.guid)
+    # A chunk nothing lists any more, and one of a file of another password
+    backend = providers.get()
+    for name in (chunking.chunk_name(entry.guid, "0" * 32), chunking.chunk_name("other-guid", "0" * 32)):
+        backend.upload(name, io.BytesIO(b"stale"))
+
+    cfe('gc')
+
+    assert chunk_files(entry.guid) == chunks
+    assert chunk_files("other-guid") != []
+
+    # The content is shared, so the chunks stay until the last name is deleted
+    cfe('delete', 'first')
+    assert chunk_files(entry.guid) == chunks
+    cfe('download', 'second', 'out')
+    assert read('out') == read('src')
+
+    cfe('delete', 'second')
+    assert chunk_files(entry.guid) == []
+    assert entry.guid + ".enc" not in remote_files()
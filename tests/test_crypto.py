@@ -0,0 +1,116 @@
+import io
+import os
+
+import pytest
+
+from cfe import compression
+from cfe.vault import crypto
+
+SEGMENT = 64
+KEY = crypto.generate_random_key()
+
+
+def encrypt(plaintext, segment_size=SEGMENT):
+    return b"".join(crypto.iter_encrypt(KEY, io.BytesIO(plaintext), segment_size))
+
+
+def decrypt(ciphertext, key=KEY):
+    return b"".join(crypto.iter_decrypt(key, io.BytesIO(ciphertext)))
+
+
+def segments(ciphertext):
+    """
+    :return: the header and the encrypted segments of a stream
+    """
+    body = ciphertext[crypto.HEADER_SIZE:]
+    size = SEGMENT + crypto.TAG_SIZE
+    return ciphertext[:crypto.HEADER_SIZE], [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def flip(data, index):
+    data = bytearray(data)
+    data[index] ^= 1
+    return bytes(data)
+
+
+@pytest.mark.parametrize('size', [0, 1, SEGMENT - 1, SEGMENT, 3 * SEGMENT, 3 * SEGMENT + 17])
+def test_round_trip(size):
+    plaintext = os.urandom(size)
+    ciphertext = encrypt(plaintext)
+
+    assert len(ciphertext) == crypto.encrypted_size(size, SEGMENT)
+    assert decrypt(ciphertext) == plaintext
+    assert crypto.decrypt(KEY, ciphertext) == plaintext
+
+
+@pytest.mark.parametrize('size', [0, SEGMENT, 3 * SEGMENT + 17])
+def test_round_trip_in_pieces(size):
+    plaintext = os.urandom(size)
+    reader = crypto.EncryptingReader(KEY, io.BytesIO(plaintext), size, segment_size=SEGMENT)
+    ciphertext = reader.read()
+    reader.seek(crypto.HEADER_SIZE + 5)
+    assert reader.read(100) == ciphertext[crypto.HEADER_SIZE + 5:crypto.HEADER_SIZE + 105]
+
+    # Pieces that split headers, segments and tags anywhere
+    decryptor = crypto.StreamDecryptor(KEY)
+    plaintext_out = b"".join(decryptor.update(ciphertext[i:i + 7]) for i in range(0, len(ciphertext), 7))
+    assert plaintext_out + decryptor.finalize() == plaintext
+
+
+def test_reordered_segments_are_rejected():
+    header, parts = segments(encrypt(os.urandom(3 * SEGMENT + 17)))
+    parts[0], parts[1] = parts[1], parts[0]
+
+    with pytest.raises(crypto.InvalidToken):
+        decrypt(header + b"".join(parts))
+
+
+def test_truncation_at_a_segment_boundary_is_rejected():
+    header, parts = segments(encrypt(os.urandom(3 * SEGMENT)))
+
+    for kept in range(1, len(parts)):
+        with pytest.raises(crypto.InvalidToken):
+            decrypt(header + b"".join(parts[:kept]))
+    with pytest.raises(crypto.InvalidToken):
+        decrypt(header)
+
+
+def test_modified_header_is_rejected():
+    ciphertext = encrypt(os.urandom(2 * SEGMENT))
+
+    # Magic, version, segment size and salt are all bound to the segments
+    for index in range(crypto.HEADER_SIZE):
+        with pytest.raises(crypto.InvalidToken):
+            decrypt(flip(ciphertext, index))
+
+
+def test_flipped_tag_is_rejected():
+    ciphertext = encrypt(os.urandom(2 * SEGMENT))
+    first_tag = crypto.HEADER_SIZE + SEGMENT
+
+    for index in (first_tag, len(ciphertext) - 1):
+        with pytest.raises(crypto.InvalidToken):
+            decrypt(flip(ciphertext, index))
+
+
+def test_wrong_key_is_rejected():
+    with pytest.raises(crypto.InvalidToken):
+        decrypt(encrypt(b"content"), crypto.generate_random_key())
+
+
+def test_compressed_stream_round_trip():
+    plaintext = b"line of a log file\n" * 100
+    compressed = io.BytesIO()
+    size = compression.compress_file(io.BytesIO(plaintext), compressed, compression.ZLIB)
+    compressed.seek(0)
+    ciphertext = crypto.EncryptingReader(KEY, compressed, size, segment_size=SEGMENT,
+                                         compression=compression.ZLIB).read()
+
+    assert ciphertext[len(crypto.STREAM_MAGIC)] == crypto.STREAM_VERSION_COMPRESSED
+    assert len(ciphertext) == crypto.encrypted_size(size, SEGMENT, compression.ZLIB)
+    assert decrypt(ciphertext) == plaintext
+
+    # Including the compression method, which is not part of a version 1 header
+    for index in range(crypto.header_size(compression.ZLIB)):
+        with pytest.raises(crypto.InvalidToken):
+            decrypt(flip(ciphertext, index))
@@ -0,0 +1,85 @@
+import json
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from pydrive2.files import ApiRequestError
+
+from cfe.drive_api import func
+from cfe.drive_api.folders import FolderCache
+
+FOLDER = ['.cfe']
+
+
+def not_found():
+    return ApiRequestError(HttpError(httplib2.Response({'status': 404}),
+                                     json.dumps({'error': {'code': 404}}).encode()))
+
+
+class FakeDrive:
+    """
+    stand-in for GoogleDrive that knows which folder ids exist and counts metadata requests
+    """
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.fetched = []
+
+    def CreateFile(self, metadata):
+        drive = self
+
+        class File(dict):
+            def FetchMetadata(self, fields=None):
+                drive.fetched.append(self['id'])
+                if self['id'] not in drive.folders:
+                    raise not_found()
+
+        return File(metadata)
+
+
+@pytest.fixture
+def folders(tmp_path, monkeypatch):
+    cache = FolderCache(str(tmp_path / 'folders.json'))
+    cache.put(FOLDER, 'cached')
+    monkeypatch.setattr(func, '_folders', cache)
+    monkeypatch.setattr(func, '_resolve_folder', lambda folder_path, drive: 'fresh')
+    return cache
+
+
+def test_missing_file_keeps_the_folder(folders):
+    drive = FakeDrive({'cached'})
+
+    def find(folder_id):
+        raise FileNotFoundError("file is not found")
+
+    with pytest.raises(FileNotFoundError):
+        func._in_folder(FOLDER, drive, find)
+    assert folders.get(FOLDER) == 'cached'
+    assert drive.fetched == []
+
+
+def test_not_found_in_an_existing_folder_keeps_it(folders):
+    drive = FakeDrive({'cached'})
+
+    def fetch(folder_id):
+        raise not_found()
+
+    with pytest.raises(ApiRequestError):
+        func._in_folder(FOLDER, drive, fetch)
+    assert folders.get(FOLDER) == 'cached'
+    assert drive.fetched == ['cached']
+
+
+def test_missing_folder_is_resolved_again(folders):
+    drive = FakeDrive({'fresh'})
+    used = []
+
+    def fetch(folder_id):
+        used.append(folder_id)
+        if folder_id not in drive.folders:
+            raise not_found()
+        return folder_id
+
+    assert func._in_folder(FOLDER, drive, fetch) == 'fresh'
+    assert used == ['cached', 'fresh']
+    assert folders.get(FOLDER) == 'fresh'
@@ -0,0 +1,93 @@
+import io
+import os
+
+import pytest
+
+from cfe.checkpoint import Checkpoint
+from cfe.drive_api.resumable import ResumableUpload, ResumableUploadError
+
+CHUNK = 256 * 1024
+CONTENT = os.urandom(4 * CHUNK + 1000)
+
+
+def upload(server, http, checkpoint=None):
+    upload = ResumableUpload(http, checkpoint or Checkpoint(), upload_url=server.upload_url, chunksize=CHUNK)
+    return upload.run('file.enc', 'folder', io.BytesIO(CONTENT))
+
+
+def test_upload(upload_server, http):
+    metadata = upload(upload_server, http)
+
+    assert upload_server.files[metadata['id']] == CONTENT
+    assert upload_server.sent_offsets() == [0, CHUNK, 2 * CHUNK, 3 * CHUNK, 4 * CHUNK]
+
+
+def test_dropped_connection_resumes_from_acknowledged_range(upload_server, http):
+    # httplib2 sends a request again once by itself when the connection drops
+    upload_server.drops = 2
+
+    metadata = upload(upload_server, http)
+
+    assert upload_server.files[metadata['id']] == CONTENT
+    # Half of the first chunk was stored before the connection died
+    assert upload_server.sent_offsets() == [0, 0, CHUNK // 2, CHUNK + CHUNK // 2, 2 * CHUNK + CHUNK // 2,
+                                            3 * CHUNK + CHUNK // 2]
+
+
+def test_interrupted_upload_resumes_from_checkpoint(upload_server, http, tmp_path):
+    path = str(tmp_path / 'file.json')
+    upload_server.drops = 100
+    with pytest.raises(ResumableUploadError):
+        upload(upload_server, http, Checkpoint(path))
+    assert Checkpoint(path).get('committed') > 0
+    held = len(next(iter(upload_server.sessions.values()))['data'])
+    upload_server.drops = 0
+    upload_server.requests.clear()
+
+    metadata = upload(upload_server, http, Checkpoint(path))
+
+    assert upload_server.files[metadata['id']] == CONTENT
+    # Continues from what the server holds, which may be more than was checkpointed
+    assert upload_server.sent_offsets()[0] == held
+    assert ('POST', None) not in upload_server.requests
+    assert not os.path.exists(path)
+
+
+def test_expired_session_starts_a_new_one(upload_server, http, tmp_path):
+    path = str(tmp_path / 'file.json')
+    upload_server.drops = 100
+    with pytest.raises(ResumableUploadError):
+        upload(upload_server, http, Checkpoint(path))
+    upload_server.drops = 0
+    upload_server.expire()
+
+    metadata = upload(upload_server, http, Checkpoint(path))
+
+    assert upload_server.files[metadata['id']] == CONTENT
+    assert [method for method, _ in upload_server.requests].count('POST') == 2
+
+
+def test_session_expiring_during_upload_starts_over(upload_server, http):
+    class Expiring(io.BytesIO):
+        # Expires the session when the third chunk is read
+        def read(self, size=-1):
+            if self.tell() == 2 * CHUNK and not upload_server.expired:
+                upload_server.expired = True
+                upload_server.expire()
+            return super().read(size)
+
+    upload_server.expired = False
+    metadata = ResumableUpload(http, Checkpoint(), upload_url=upload_server.upload_url,
+                               chunksize=CHUNK).run('file.enc', 'folder', Expiring(CONTENT))
+
+    assert upload_server.files[metadata['id']] == CONTENT
+    assert upload_server.sent_offsets().count(0) == 2
+
+
+def test_unreachable_endpoint_is_an_io_error(upload_server, http):
+    upload_server.shutdown()
+    upload_server.server_close()
+
+    with pytest.raises(ResumableUploadError) as error:
+        upload(upload_server, http)
+    assert isinstance(error.value, IOError)
@@ -0,0 +1,218 @@
+import json
+import os
+
+import pytest
+
+from cfe.vault import crypto, storage
+
+KDF = crypto.KdfParams(2**10, 8, 1)
+
+
+@pytest.fixture(autouse=True)
+def vault_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.dirname(storage.VAULT_PATH))
+    storage.create_vault(KDF)
+
+
+def test_writers_keep_each_others_records():
+    a = storage.Vault("password")
+    a.create_data("seed", "guid-0")
+    b = storage.Vault("password")
+
+    a.create_data("from-a", "guid-1")
+    b.create_data("from-b", "guid-2")
+    b.delete_data("seed")
+
+    assert sorted(storage.Vault("password").entries) == ["from-a", "from-b"]
+    assert sorted(b.entries) == ["from-a", "from-b"]
+
+
+def test_writer_catches_up_with_a_snapshot():
+    a = storage.Vault("password")
+    entry = a.create_data("from-a", "guid-1")
+    b = storage.Vault("password")
+    b.create_data("from-b", "guid-2")
+    b.rekey(KDF)
+
+    entry.file_id = "file-1"
+    a.update_data(entry)
+
+    v = storage.Vault("password")
+    assert sorted(v.entries) == ["from-a", "from-b"]
+    assert v.get_data("from-a").file_id == "file-1"
+
+
+def test_torn_tail_is_dropped():
+    a = storage.Vault("password")
+    a.create_data("first", "guid-1")
+    with open(storage.VAULT_PATH, "ab") as f:
+        f.write(b"\x03\x00\x00\x10\x00torn")
+
+    storage.Vault("password").create_data("second", "guid-2")
+
+    assert sorted(storage.Vault("password").entries) == ["first", "second"]
+
+
+def test_content_macs_survive_rekey():
+    v = storage.Vault("password")
+    entry = v.create_data("file", "guid-1")
+    with open("file", "wb") as f:
+        f.write(b"content")
+    with open("file", "rb") as f:
+        entry.content_mac = v.get_content_mac(f)
+    entry.file_id = "file-1"
+    v.update_data(entry)
+
+    v.rekey(crypto.KdfParams(2**11, 8, 1))
+    v.rekey(KDF)
+
+    for vault in (v, storage.Vault("password")):
+        with open("file", "rb") as f:
+            assert vault.find_content(vault.get_content_mac(f)).nickname == "file"
+
+
+def legacy_record(password, nickname, guid, key):
+    # Per-entry records of vaults from before the header, each with its own scrypt salt
+    return storage.VaultEntry(nickname, guid, key).encrypt_entry(password) + b"\n"
+
+
+def untagged_record(vault_key, nickname, guid, key):
+    # Version 2 records: a nonce and the entry under a subkey of the vault password key, without a key check tag
+    nonce = os.urandom(storage.NONCE_SIZE)
+    entry = json.dumps({"name": f"{nickname} {guid}", "key": key.decode()})
+    return storage._pack_record(storage.RECORD_UNTAGGED,
+                                nonce + crypto.encrypt(crypto.derive_subkey(vault_key, nonce, b"cfe vault entry"), entry))
+
+
+def records():
+    with open(storage.VAULT_PATH, "rb") as f:
+        data = f.read()
+    return storage._read_records(data, storage._HEADER.size)[0]
+
+
+def test_legacy_vault_is_migrated():
+    keys = [crypto.generate_random_key() for _ in range(2)]
+    with open(storage.VAULT_PATH, "wb") as f:
+        f.write(legacy_record("password", "a file", "guid-1", keys[0]))
+        f.write(legacy_record("other", "theirs", "guid-2", keys[1]))
+
+    v = storage.Vault("password")
+
+    assert [(e.nickname, e.guid, e.entry_key) for e in v.get_data_list()] == [("a file", "guid-1", keys[0])]
+    with open(storage.VAULT_PATH, "rb") as f:
+        assert f.read(len(storage.VAULT_MAGIC) + 1) == storage.VAULT_MAGIC + bytes([storage.VAULT_VERSION])
+    # The other password's record is kept as it is until its owner opens the vault
+    assert [record_type for record_type, _ in records()] == [storage.RECORD_ENTRY, storage.RECORD_LEGACY]
+    assert storage.Vault("other").get_data("theirs").entry_key == keys[1]
+    assert storage.Vault("password").get_data("a file").guid == "guid-1"
+    assert all(record_type == storage.RECORD_ENTRY for record_type, _ in records())
+
+
+def test_version_2_vault_is_migrated():
+    salt = os.urandom(16)
+    key = crypto.generate_random_key()
+    vault_key = crypto.generate_password_key("password", salt)
+    with open(storage.VAULT_PATH, "wb") as f:
+        f.write(storage._HEADER_V2.pack(storage.VAULT_MAGIC, 2, salt))
+        f.write(untagged_record(vault_key, "a file", "guid-1", key))
+
+    v = storage.Vault("password")
+
+    assert v.get_data("a file").entry_key == key
+    # Rewritten with a version 3 header that records the default parameters, under the same salt
+    assert storage._unpack_header(open(storage.VAULT_PATH, "rb").read()) == (salt, crypto.DEFAULT_KDF,
+                                                                            storage._HEADER.size)
+    assert [record_type for record_type, _ in records()] == [storage.RECORD_ENTRY]
+    assert storage.Vault("password").get_data("a file").guid == "guid-1"
+
+
+def test_other_passwords_records_are_skipped_on_the_tag(monkeypatch):
+    theirs = storage.Vault("other")
+    theirs.add_data([storage.VaultEntry(f"theirs-{i}", f"guid-{i}") for i in range(20)])
+    storage.Vault("password").create_data("mine", "guid-mine")
+
+    unsealed = []
+    unseal = storage.VaultEntry.unseal
+    monkeypatch.setattr(storage.VaultEntry, "unseal",
+                        lambda self, *args: unsealed.append(self) or unseal(self, *args))
+    v = storage.Vault("password")
+
+    assert [*v.entries] == ["mine"]
+    assert len(unsealed) == 1
+    assert len(v.other_entries) == 20
+    # A wrong password matches no tag and opens nothing
+    unsealed.clear()
+    assert storage.Vault("wrong").entries == {}
+    assert unsealed == []
+
+
+def test_compaction_keeps_other_passwords_records(monkeypatch):
+    monkeypatch.setattr(storage, "COMPACT_MIN", 4)
+    storage.Vault("other").add_data([storage.VaultEntry(f"theirs-{i}", f"guid-{i}") for i in range(3)])
+    v = storage.Vault("password")
+    v.create_data("kept", "guid-kept")
+
+    for i in range(4):
+        v.create_data(f"mine-{i}", f"guid-mine-{i}")
+        v.delete_data(f"mine-{i}")
+
+    # The tombstones and the records they deleted are gone
+    assert [record_type for record_type, _ in records()] == [storage.RECORD_ENTRY] * 4
+    assert sorted(storage.Vault("other").entries) == ["theirs-0", "theirs-1", "theirs-2"]
+    assert [*storage.Vault("password").entries] == ["kept"]
+
+
+def test_tombstones_of_other_passwords_are_replayed(monkeypatch):
+    monkeypatch.setattr(storage, "COMPACT_MIN", 2)
+    theirs = storage.Vault("other")
+    theirs.create_data("deleted", "guid-1")
+    theirs.create_data("kept", "guid-2")
+    v = storage.Vault("password")
+    assert len(v.other_entries) == 2
+
+    theirs.delete_data("deleted")
+    v.create_data("mine", "guid-3")
+
+    # Catching up dropped the deleted record, so it is not written back when compacting
+    assert len(v.other_entries) == 1
+    v.create_data("more", "guid-4")
+    v.delete_data("more")
+    assert storage.RECORD_DELETE not in [record_type for record_type, _ in records()]
+    assert [*storage.Vault("other").entries] == ["kept"]
+    assert [*storage.Vault("password").entries] == ["mine"]
+
+
+def test_get_data_list_pages_by_prefix_and_range():
+    v = storage.Vault("password")
+    names = ["a", "b/1", "b/2", "b/3", "ba", "c"]
+    v.add_data([storage.VaultEntry(name, f"guid-{name}") for name in reversed(names)])
+
+    def nicknames(*args, **kwargs):
+        return [entry.nickname for entry in v.get_data_list(*args, **kwargs)]
+
+    assert nicknames() == names
+    assert nicknames("b/") == ["b/1", "b/2", "b/3"]
+    assert nicknames("b") == ["b/1", "b/2", "b/3", "ba"]
+    assert nicknames("d") == []
+    # end is exclusive, and a page after "b/2" starts just past it
+    assert nicknames("b/", end="b/3") == ["b/1", "b/2"]
+    assert nicknames("b/", start="b/2\0") == ["b/3"]
+    assert nicknames(start="b/2", end="c") == ["b/2", "b/3", "ba"]
+    assert nicknames("b/", start="a") == ["b/1", "b/2", "b/3"]
+
+    v.delete_data("b/2")
+    assert nicknames("b/") == ["b/1", "b/3"]
+
+
+def test_legacy_nickname_with_commas_is_migrated():
+    key = crypto.generate_random_key()
+    with open(storage.VAULT_PATH, "wb") as f:
+        f.write(legacy_record("password", "report, final, v2.txt", "guid-1", key))
+        f.write(legacy_record("password", "plain.txt", "guid-2", crypto.generate_random_key()))
+
+    v = storage.Vault("password")
+
+    assert [entry.nickname for entry in v.get_data_list()] == ["plain.txt", "report, final, v2.txt"]
+    assert v.get_data("report, final, v2.txt").entry_key == key
+    assert storage.Vault("password").get_data("report, final, v2.txt").guid == "guid-1"